@@ -21,7 +21,14 @@ class Castro:
                  framerate = 12,
                  clipping = None,
                  port = None,
-                 passwd   = os.path.join(os.path.expanduser("~"), ".vnc", "passwd")):
+                 passwd   = os.path.join(os.path.expanduser("~"), ".vnc", "passwd"),
+                 pixel_format = None,
+                 throttle = None,
+                 queue = None,
+                 stats = None,
+                 encoding = None,
+                 threads = None,
+                 screenvideo = None):
         self.filename = filename
         self.filepath = os.path.join(DATA_DIR, self.filename)
         self.host = host
@@ -30,6 +37,13 @@ class Castro:
         self.clipping = clipping
         self.passwd = passwd
         self.port = port
+        self.pixel_format = pixel_format
+        self.throttle = throttle
+        self.queue = queue
+        self.stats = stats
+        self.encoding = encoding
+        self.threads = threads
+        self.screenvideo = screenvideo
         
         # Post-process data: 
         self.duration = 0        
@@ -61,6 +75,41 @@ class Castro:
             args.insert(4, '-C')
             args.insert(5, self.clipping)
 
+        # If pixel format is specified (e.g. "rgb565"), insert it into args
+        if self.pixel_format:
+            args.insert(4, '-f')
+            args.insert(5, self.pixel_format)
+
+        # If throttling is specified (lookahead in seconds), insert it into args
+        if self.throttle is not None:
+            args.insert(4, '-T')
+            args.insert(5, str(self.throttle))
+
+        # If an encoder queue is specified (e.g. "16:merge"), insert it into args
+        if self.queue:
+            args.insert(4, '-Q')
+            args.insert(5, str(self.queue))
+
+        # If a stats interval is specified (in seconds), insert it into args
+        if self.stats:
+            args.insert(4, '-I')
+            args.insert(5, str(self.stats))
+
+        # If encodings are specified (e.g. "auto" or "zrle,hextile"), insert them into args
+        if self.encoding:
+            args.insert(4, '-e')
+            args.insert(5, self.encoding)
+
+        # If a number of compression threads is specified (1: serial), insert it into args
+        if self.threads:
+            args.insert(4, '-j')
+            args.insert(5, str(self.threads))
+
+        # If a ScreenVideo version is specified (1 for old players), insert it into args
+        if self.screenvideo:
+            args.insert(4, '-v')
+            args.insert(5, str(self.screenvideo))
+
         if self.port:
             args.append(str(self.port))
 
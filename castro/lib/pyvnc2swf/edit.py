@@ -78,7 +78,7 @@ def reorganize(info, stream, moviefiles, range_str='-',
     elif fname.endswith('.flv'):
       # flv file
       movie.parse_flv(fname, True, debug=debug)
-    elif fname.endswith('.vnc'):
+    elif fname.endswith('.vnc') or fname.endswith('.vncz'):
       # vncrec file
       movie.parse_vncrec(fname, debug=debug)
     else:
@@ -102,7 +102,7 @@ def main(argv):
     print('''usage: %s
     [-d] [-c] [-t type] [-f|-F frames] [-a mp3file] [-r framerate]
     [-S mp3sampleskip] [-C WxH+X+Y] [-B blocksize] [-K keyframe]
-    [-R framestep] [-s scaling]
+    [-R framestep] [-s scaling] [-j threads] [-v {1,2}]
     -o outfile.swf file1 file2 ...
 
     Specify one output filename from the following:
@@ -122,6 +122,9 @@ def main(argv):
     -r framerate: override framerate.
     -B blocksize: (SWF7 and FLV mode only) blocksize of video packet (must be a multiple of 16)
     -K keyframe: keyframe interval
+    -j threads: (SWF7 and FLV mode only) threads for compressing video blocks (default: the number of CPUs, 1: serial)
+    -v {1,2}: (SWF7 and FLV mode only) ScreenVideo version (default: 2 for FLV, 1 for SWF)
+       2 is smaller but keeps only 15-bit colors (except the 128 palette colors).
     -S N[s]: skip the first N samples (or N seconds) of the sound when the movie starts.
     -C WxH+X+Y: crop a specific area of the movie.
     -b: disable seekbar.
@@ -130,7 +133,7 @@ def main(argv):
     ''' % argv[0], file=stderr)
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'dr:o:t:cHa:S:C:B:K:f:F:R:s:blz')
+    (opts, args) = getopt.getopt(argv[1:], 'dr:o:t:cHa:S:C:B:K:f:F:R:s:blzj:v:')
   except getopt.GetoptError:
     return usage()
   #
@@ -179,6 +182,11 @@ def main(argv):
       info.blocksize = blocksize
     elif k == '-K':
       kfinterval = int(v)
+    elif k == '-j':
+      info.threads = int(v)
+    elif k == '-v':
+      info.screenvideo = int(v)
+      assert info.screenvideo in (1, 2), 'Invalid ScreenVideo version.'
     elif k == '-c':
       info.compression = True
     elif k == '-f':
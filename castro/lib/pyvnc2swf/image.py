@@ -23,7 +23,8 @@
 ##  USA.
 ##
 
-import sys
+import sys, re
+from io import BytesIO
 lowerbound = max
 upperbound = min
 
@@ -33,13 +34,98 @@ stderr = sys.stderr
 #          2: raw (uncompressed)
 #          3: DefineBitLossless
 #          4: SCREENVIDEOPACKET
+#          5: copy within the screen (CopyRect)
 IMG_SOLID = 1
 IMG_RAW = 2
 IMG_LOSSLESS = 3
 IMG_VIDEOPACKET = 4
+IMG_COPYRECT = 5
 
+try:
+  # numpy is optional (see SWFVideoScreen.get_block_changes).
+  import numpy
+except ImportError:
+  numpy = None
+
+# Channel conversions. These are done with extended slices
+# so that no pixel is touched in Python.
+
+# BGR -> RGB (and vice versa)
 def bgr2rgb(data):
-  return ''.join([ data[i+2]+data[i+1]+data[i] for i in range(0, len(data), 3) ])
+  b = bytearray(data)
+  b[0::3] = data[2::3]
+  b[2::3] = data[0::3]
+  return bytes(b)
+
+# ARGB -> RGBA
+def argb2rgba(data):
+  b = bytearray(len(data))
+  b[:-1] = data[1:]
+  b[3::4] = data[0::4]
+  return bytes(b)
+
+# XRGB -> RGBX (X is ignored)
+def xrgb2rgbx(data):
+  b = bytearray(len(data))
+  b[:-1] = data[1:]
+  return bytes(b)
+
+##  Screen Video V2 hybrid color (15/7 bit)
+##
+##  Each pixel is either one byte (0x00-0x7f), an index into the
+##  default palette, or two bytes of a 15-bit color (1rrrrrgg gggbbbbb).
+##  Colors that are not in the palette lose their lowest three bits.
+##
+SCREENVIDEO2_PALETTE = (
+  0x000000, 0x333333, 0x666666, 0x999999, 0xcccccc, 0xffffff, 0x330000, 0x660000,
+  0x990000, 0xcc0000, 0xff0000, 0x003300, 0x006600, 0x009900, 0x00cc00, 0x00ff00,
+  0x000033, 0x000066, 0x000099, 0x0000cc, 0x0000ff, 0x333300, 0x666600, 0x999900,
+  0xcccc00, 0xffff00, 0x003333, 0x006666, 0x009999, 0x00cccc, 0x00ffff, 0x330033,
+  0x660066, 0x990099, 0xcc00cc, 0xff00ff, 0xffff33, 0xffff66, 0xffff99, 0xffffcc,
+  0xff33ff, 0xff66ff, 0xff99ff, 0xffccff, 0x33ffff, 0x66ffff, 0x99ffff, 0xccffff,
+  0xcccc33, 0xcccc66, 0xcccc99, 0xccccff, 0xcc33cc, 0xcc66cc, 0xcc99cc, 0xccffcc,
+  0x33cccc, 0x66cccc, 0x99cccc, 0xffcccc, 0x999933, 0x999966, 0x9999cc, 0x9999ff,
+  0x993399, 0x996699, 0x99cc99, 0x99ff99, 0x339999, 0x669999, 0xcc9999, 0xff9999,
+  0x666633, 0x666699, 0x6666cc, 0x6666ff, 0x663366, 0x669966, 0x66cc66, 0x66ff66,
+  0x336666, 0x996666, 0xcc6666, 0xff6666, 0x333366, 0x333399, 0x3333cc, 0x3333ff,
+  0x336633, 0x339933, 0x33cc33, 0x33ff33, 0x663333, 0x993333, 0xcc3333, 0xff3333,
+  0x003366, 0x336600, 0x660033, 0x006633, 0x330066, 0x663300, 0x336699, 0x669933,
+  0x993366, 0x339966, 0x663399, 0x996633, 0x6699cc, 0x99cc66, 0xcc6699, 0x66cc99,
+  0x9966cc, 0xcc9966, 0x99ccff, 0xccff99, 0xff99cc, 0x99ffcc, 0xcc99ff, 0xffcc99,
+  0x111111, 0x222222, 0x444444, 0x555555, 0xaaaaaa, 0xbbbbbb, 0xdddddd, 0xeeeeee,
+)
+
+# the palette sorted by color, for numpy.searchsorted.
+if numpy is not None:
+  HYBRID_PALETTE_ORDER = numpy.argsort(SCREENVIDEO2_PALETTE)
+  HYBRID_PALETTE_KEYS = numpy.array(SCREENVIDEO2_PALETTE, dtype=numpy.uint32)[HYBRID_PALETTE_ORDER]
+
+# BGR -> hybrid color. Returns None without numpy.
+def bgr2hybrid(data):
+  if numpy is None:
+    return None
+  p = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3).astype(numpy.uint16)
+  (b, g, r) = (p[:,0], p[:,1], p[:,2])
+  key = (r.astype(numpy.uint32) << 16) | (g.astype(numpy.uint32) << 8) | b
+  i = numpy.minimum(numpy.searchsorted(HYBRID_PALETTE_KEYS, key), 127)
+  hit = HYBRID_PALETTE_KEYS[i] == key
+  c = 0x8000 | ((r >> 3) << 10) | ((g >> 3) << 5) | (b >> 3)
+  out = numpy.stack([ numpy.where(hit, HYBRID_PALETTE_ORDER[i], c >> 8), c & 255 ], axis=1).astype(numpy.uint8)
+  # the second byte is dropped for the palette colors.
+  return out[numpy.stack([ numpy.ones(len(hit), dtype=bool), ~hit ], axis=1)].tobytes()
+
+# hybrid color -> BGR.
+HYBRID_PIXEL = re.compile(rb'[\x80-\xff].|[\x00-\x7f]', re.DOTALL)
+HYBRID_TABLE = {}
+def hybrid2bgr(data):
+  if not HYBRID_TABLE:
+    for (i, c) in enumerate(SCREENVIDEO2_PALETTE):
+      HYBRID_TABLE[bytes([i])] = bytes([c & 255, (c >> 8) & 255, c >> 16])
+    # 5 bits are expanded to 8 bits as 11111 -> 11111111.
+    e = [ (v << 3) | (v >> 2) for v in range(32) ]
+    for c in range(32768):
+      HYBRID_TABLE[bytes([0x80 | (c >> 8), c & 255])] = bytes([e[c & 31], e[(c >> 5) & 31], e[c >> 10]])
+  return b''.join(map(HYBRID_TABLE.__getitem__, HYBRID_PIXEL.findall(data)))
 
 try:
   # try to pygame 1.6 or newer.
@@ -58,16 +144,19 @@ try:
   def create_image_from_string_rgbx(w, h, data):
     return pygame.image.fromstring(data, (w, h), 'RGBX')
   def create_image_from_string_xrgb(w, h, data):
-    return pygame.image.fromstring(data[1:]+'x', (w, h), 'RGBX')
+    return pygame.image.fromstring(xrgb2rgbx(data), (w, h), 'RGBX')
   def create_image_from_string_argb(w, h, data):
-    data = ''.join([ data[i+1]+data[i+2]+data[i+3]+data[i] for i in range(0, len(data), 4) ])
-    return pygame.image.fromstring(data, (w, h), 'RGBA')
+    return pygame.image.fromstring(argb2rgba(data), (w, h), 'RGBA')
   def create_image_from_string_rgb_flipped(w, h, data):
     return pygame.image.fromstring(data, (w, h), 'RGB', 1)
+  def create_image_from_jpeg(data):
+    return pygame.image.load(BytesIO(data), 'image.jpg')
   def crop_image(img, xxx_todo_changeme):
     (x,y,w,h) = xxx_todo_changeme
     (wm,hm) = img.get_size()
     return img.subsurface((x,y,upperbound(wm-x,w),upperbound(hm-y,h)))
+  def copy_image(img):
+    return img.copy()
   def paste_image(dest, src, xxx_todo_changeme1):
     (x0, y0) = xxx_todo_changeme1
     return dest.blit(src, (x0, y0))
@@ -81,6 +170,13 @@ try:
     return pygame.image.tostring(img, 'RGB')
   def convert_image_to_string_xrgb(img):
     return pygame.image.tostring(img, 'ARGB')
+  # numpy views of the image. The surface is locked while they are in use.
+  def convert_image_to_array(img):
+    # (height, width, RGB)
+    return pygame.surfarray.pixels3d(img).transpose(1, 0, 2)
+  def convert_image_to_pixels(img):
+    # (height, width) of packed pixels, only to be compared.
+    return pygame.surfarray.pixels2d(img).transpose()
   def solid_fill(dest, rect, color):
     return dest.fill(color, rect)
   def scale_image(img, scaling):
@@ -104,15 +200,19 @@ except ImportError:
   def create_image_from_string_rgbx(w, h, data):
     return Image.fromstring('RGB', (w, h), data, 'raw', 'RGBX')
   def create_image_from_string_xrgb(w, h, data):
-    return Image.fromstring('RGB', (w, h), data[1:]+'x', 'raw', 'RGBX')
+    return Image.fromstring('RGB', (w, h), xrgb2rgbx(data), 'raw', 'RGBX')
   def create_image_from_string_argb(w, h, data):
     return Image.fromstring('RGBA', (w, h), data, 'raw', 'ARGB')
   def create_image_from_string_rgb_flipped(w, h, data):
     return Image.fromstring('RGB', (w, h), data, 'raw', 'RGB').transpose(Image.FLIP_TOP_BOTTOM)
+  def create_image_from_jpeg(data):
+    return Image.open(BytesIO(data)).convert('RGB')
   def crop_image(img, xxx_todo_changeme2):
     (x0,y0,w,h) = xxx_todo_changeme2
     (wm,hm) = img.size
     return img.crop((x0, y0, upperbound(x0+w,wm), upperbound(y0+h,hm)))
+  def copy_image(img):
+    return img.copy()
   def paste_image(dest, src, xxx_todo_changeme3):
     (x0, y0) = xxx_todo_changeme3
     return dest.paste(src, (x0, y0))
@@ -124,6 +224,10 @@ except ImportError:
     return img.tostring('raw', 'RGB')
   def convert_image_to_string_xrgb(img):
     return img.tostring('raw', 'XRGB')
+  def convert_image_to_array(img):
+    return numpy.asarray(img)
+  def convert_image_to_pixels(img):
+    return numpy.asarray(img.convert('RGBX')).view('<u4')[:,:,0]
   def solid_fill(dest, xxx_todo_changeme4, color):
     (x0,y0,w,h) = xxx_todo_changeme4
     return dest.paste(color, (x0, y0, x0+w, y0+h))
@@ -24,10 +24,11 @@
 ##
 
 import sys, zlib, re
+from bisect import bisect_right
 from .swf import SWFParser, FLVParser, CURSOR_DEPTH
 from .mp3 import MP3Reader, MP3Storage
 from .rfb import RFBMovieConverter
-from .image import IMG_LOSSLESS, IMG_VIDEOPACKET
+from .image import IMG_RAW, IMG_LOSSLESS, IMG_VIDEOPACKET, bgr2rgb, hybrid2bgr
 from . import html_templates
 stderr = sys.stderr
 lowerbound = max
@@ -51,6 +52,10 @@ class SWFInfo:
     self.framerate = None
     self.scaling = None
     self.blocksize = None
+    # threads for compressing video blocks (None: one per CPU, 1: serial).
+    self.threads = None
+    # ScreenVideo version (None: 2 for FLV, 1 for SWF).
+    self.screenvideo = None
     self.swf_version = None
     self.width = None
     self.height = None
@@ -181,18 +186,87 @@ class MovieContainer:
     self.nframes += nframes
     return self
 
-  def parse_vncrec(self, fname, debug=0):
+  def parse_vncrec(self, fname, debug=0, use_index=True):
     parser = RFBMovieConverter(self, debug=debug)
-    parser.open(fname)
+    parser.open(fname, use_index=use_index)
     nframes = len(parser.frameinfo)
     self.parsers.append( (nframes, parser) )
     self.nframes += nframes
     return self
 
 
+##  ScreenVideoParserMixin
+##
+##  Reads SCREENVIDEOPACKET (codec 3) and SCREENV2VIDEOPACKET (codec 6).
+##  V2 blocks are decompressed here, because a block can be primed
+##  with the same block of the last keyframe (ZlibPrimePrevious).
+##  A custom palette, IFrameImage and diff blocks are not supported.
+##
+class ScreenVideoParserMixin:
+
+  def init_video(self):
+    # the last keyframe and its decompressed blocks.
+    self.keyframe = None
+    self.keyblocks = {}
+    return
+
+  def read_video_packet(self, frameid, frametype, codecid):
+    (blockwidth, imagewidth) = self.readbits(4), self.readbits(12)
+    (blockheight, imageheight) = self.readbits(4), self.readbits(12)
+    blockwidth = (blockwidth+1)*16
+    blockheight = (blockheight+1)*16
+    if self.debug:
+      print('VideoPacket', frameid, frametype, codecid, ':',  blockwidth, imagewidth, blockheight, imageheight, file=stderr)
+    if codecid == 6:
+      if self.readui8():
+        print('Unsupported ScreenVideo V2 packet (IFrameImage or palette).', file=stderr)
+        return
+      if frametype == 1:
+        (self.keyframe, self.keyblocks) = (frameid, {})
+    hblocks = (imagewidth+blockwidth-1)//blockwidth
+    vblocks = (imageheight+blockheight-1)//blockheight
+    for y in range(0, vblocks):
+      for x in range(0, hblocks):
+        length = self.readub16()
+        if not length: continue
+        x0 = x*blockwidth
+        y0 = imageheight-(y+1)*blockheight
+        w = upperbound(blockwidth, imagewidth-x0)
+        h = blockheight
+        if y0 < 0:
+          h += y0
+          y0 = 0
+        if codecid == 3:
+          data = self.read(length)
+          self.images.append( ((x0,y0), (w,h,(IMG_VIDEOPACKET,data))) )
+          continue
+        flags = self.readui8()
+        data = self.read(length-1)
+        # only BGR or hybrid color (ColorDepth 0 or 2) and ZlibPrimePrevious.
+        if flags & 0xee:
+          print('Unsupported ScreenVideo V2 block: flags=%r' % flags, file=stderr)
+          continue
+        z = zlib.decompressobj()
+        if flags & 1:
+          # ZlibPrimePrevious
+          if (x,y) not in self.keyblocks: continue
+          c = zlib.compressobj(0)
+          z.decompress(c.compress(self.keyblocks[(x,y)])+c.flush(zlib.Z_SYNC_FLUSH))
+        data = z.decompress(data)
+        if frametype == 1:
+          self.keyblocks[(x,y)] = data
+        if flags & 0x10:
+          data = hybrid2bgr(data)
+        # flipped BGR -> RGB
+        n = w*3
+        data = bgr2rgb(b''.join( data[i:i+n] for i in range(len(data)-n, -1, -n) ))
+        self.images.append( ((x0,y0), (w,h,(IMG_RAW,data))) )
+    return
+
+
 ##  VNC2SWF_Parser
 ##
-class VNC2SWF_Parser(SWFParser):
+class VNC2SWF_Parser(ScreenVideoParserMixin, SWFParser):
 
   """
   VNC2SWF_Parser parses a SWF file which is specifically
@@ -205,19 +279,28 @@ class VNC2SWF_Parser(SWFParser):
     self.movie = movie
     self.read_mp3 = read_mp3
     self.video1_cid = None
+    self.video1_codec = None
+    # frames with a ScreenVideo V2 keyframe.
+    self.keyframes = []
+    self.init_video()
     return
 
   def parse_header(self):
     SWFParser.parse_header(self)
     (x,width, y,height) = self.rect
     print('Input movie: version=%d, size=%dx%d, framerate=%dfps, frames=%d, duration=%.1fs.' % \
-          (self.swf_version, width/20, height/20, self.framerate,
+          (self.swf_version, width//20, height//20, self.framerate,
            self.framecount, self.framecount/float(self.framerate)), file=stderr)
     self.movie.info.set_framerate(self.framerate)
-    self.movie.info.set_defaults(width/20, height/20)
+    self.movie.info.set_defaults(width//20, height//20)
     return
 
   def parse_frame(self, i):
+    # V2 blocks may need the last keyframe.
+    k = bisect_right(self.keyframes, i)-1
+    if 0 <= k and self.keyframes[k] not in (i, self.keyframe):
+      self.parse_frame(self.keyframes[k])
+    self.frameid = i
     self.image1 = {}
     self.shape1 = None
     self.images = []
@@ -337,13 +420,23 @@ class VNC2SWF_Parser(SWFParser):
     height = self.readui16()
     flags = self.readui8() # ignore this.
     codec = self.readui8() # must be ScreenVideo
-    if codec == 3:
+    if codec in (3, 6):
       self.video1_cid = cid
+      self.video1_codec = codec
       if self.debug:
         print('DefineVideoStream', cid, frames, width, height, flags, codec, file=stderr)
     return
   def do_tag60(self, tag, length):
     return
+
+  def scan_tag61(self, tag, length):
+    # VideoFrame
+    stream_id = self.readui16()
+    if self.video1_cid != stream_id or self.video1_codec != 6: return
+    self.readui16()
+    if self.readui8() >> 4 == 1:
+      self.keyframes.append(len(self.framepos))
+    return
   
   def do_tag61(self, tag, length):
     # VideoFrame
@@ -352,28 +445,8 @@ class VNC2SWF_Parser(SWFParser):
     framenum = self.readui16()
     self.setbuff()
     (frametype, codecid) = self.readbits(4), self.readbits(4)
-    if codecid != 3: return # must be ScreenVideo
-    (blockwidth, imagewidth) = self.readbits(4), self.readbits(12)
-    (blockheight, imageheight) = self.readbits(4), self.readbits(12)
-    blockwidth = (blockwidth+1)*16
-    blockheight = (blockheight+1)*16
-    if self.debug:
-      print('VideoFrame', framenum, frametype, ':',  blockwidth, imagewidth, blockheight, imageheight, file=stderr)
-    hblocks = (imagewidth+blockwidth-1)/blockwidth
-    vblocks = (imageheight+blockheight-1)/blockheight
-    for y in range(0, vblocks):
-      for x in range(0, hblocks):
-        length = self.readub16()
-        if length:
-          data = self.read(length)
-          x0 = x*blockwidth
-          y0 = imageheight-(y+1)*blockheight
-          w = upperbound(blockwidth, imagewidth-x0)
-          h = blockheight
-          if y0 < 0:
-            h += y0
-            y0 = 0
-          self.images.append( ((x0,y0), (w,h,(IMG_VIDEOPACKET,data))) )
+    if codecid not in (3, 6): return # must be ScreenVideo
+    self.read_video_packet(self.frameid, frametype, codecid)
     return
   
   def scan_tag18(self, tag, length):
@@ -418,13 +491,16 @@ class VNC2SWF_Parser(SWFParser):
 
 ##  FLVMovieParser
 ##
-class FLVMovieParser(FLVParser):
+class FLVMovieParser(ScreenVideoParserMixin, FLVParser):
 
   def __init__(self, movie, read_mp3, debug=0):
     FLVParser.__init__(self, debug=debug)
     self.movie = movie
     self.read_mp3 = read_mp3
     self.framerate = 12
+    # tags with a ScreenVideo V2 keyframe.
+    self.keytags = []
+    self.init_video()
     return
 
   def open(self, fname):
@@ -438,6 +514,11 @@ class FLVMovieParser(FLVParser):
         (_, imageheight) = self.readbits(4), self.readbits(12)
         self.movie.info.set_defaults(imagewidth, imageheight)
         break
+    for (tagid, (tag, _, _, offset)) in enumerate(self.tags):
+      if tag == 9:
+        self.fp.seek(offset)
+        if self.readui8() == 0x16:      # keyframe, ScreenVideo V2
+          self.keytags.append(tagid)
     self.frames = []
     tagids = []
     for (tagid,(_,_,t,_)) in enumerate(self.tags):
@@ -449,9 +530,16 @@ class FLVMovieParser(FLVParser):
     return
 
   def parse_frame(self, i):
+    tagids = self.frames[i]
+    # V2 blocks may need the last keyframe (its images are not used).
+    if tagids:
+      k = bisect_right(self.keytags, tagids[0])-1
+      if 0 <= k and self.keytags[k] not in (tagids[0], self.keyframe):
+        self.images = []
+        self.process_tag(self.keytags[k])
     self.images = []
     self.othertags = []
-    for tagid in self.frames[i]:
+    for tagid in tagids:
       self.process_tag(tagid)
     return (self.images, self.othertags, (None, None))
 
@@ -461,28 +549,8 @@ class FLVMovieParser(FLVParser):
     self.fp.seek(offset)
     self.setbuff()
     (frametype, codecid) = self.readbits(4), self.readbits(4)
-    if codecid != 3: return # must be ScreenVideo
-    (blockwidth, imagewidth) = self.readbits(4), self.readbits(12)
-    (blockheight, imageheight) = self.readbits(4), self.readbits(12)
-    blockwidth = (blockwidth+1)*16
-    blockheight = (blockheight+1)*16
-    if self.debug:
-      print('VideoFrame', framenum, frametype, ':',  blockwidth, imagewidth, blockheight, imageheight, file=stderr)
-    hblocks = (imagewidth+blockwidth-1)/blockwidth
-    vblocks = (imageheight+blockheight-1)/blockheight
-    for y in range(0, vblocks):
-      for x in range(0, hblocks):
-        length = self.readub16()
-        if length:
-          data = self.read(length)
-          x0 = x*blockwidth
-          y0 = imageheight-(y+1)*blockheight
-          w = upperbound(blockwidth, imagewidth-x0)
-          h = blockheight
-          if y0 < 0:
-            h += y0
-            y0 = 0
-          self.images.append( ((x0,y0), (w,h,(IMG_VIDEOPACKET,data))) )
+    if codecid not in (3, 6): return # must be ScreenVideo
+    self.read_video_packet(tagid, frametype, codecid)
     return
 
 
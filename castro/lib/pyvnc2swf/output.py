@@ -23,7 +23,10 @@
 ##  USA.
 ##
 
-import sys, zlib
+import sys, os, zlib, time, threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from .swf import SWFWriter, FLVWriter, CURSOR_DEPTH
 from .image import *
 stderr = sys.stderr
@@ -116,6 +119,18 @@ class SWFScreen:
       data = zlib.decompress(data)
       assert len(data) == (w*h*3)
       img = create_image_from_string_rgb_flipped(w, h, bgr2rgb(data))
+    elif format == IMG_COPYRECT:
+      # copy within the screen (the source may overlap the destination)
+      (sx, sy) = data
+      (sx, sy) = (sx-self.x0, sy-self.y0)
+      # the part of the source outside the screen is not copied.
+      (dx, dy) = (lowerbound(0, -sx), lowerbound(0, -sy))
+      w = upperbound(w, self.width-sx) - dx
+      h = upperbound(h, self.height-sy) - dy
+      if w <= 0 or h <= 0:
+        return True
+      img = copy_image(crop_image(self.buf, (sx+dx, sy+dy, w, h)))
+      (x0, y0) = (x0+dx, y0+dy)
     else:
       assert 0, 'illegal image format: %d' % format
     # sometime the pasted image doesn't fit in the screen, but just let it out.
@@ -230,15 +245,17 @@ class SWFVideoScreen(SWFBlockScreen):
   def init_blocks(self):
     self.block_changed = [ [True]*self.hblocks for i in range(self.vblocks) ]
     self.block_image = [ [None]*self.hblocks for i in range(self.vblocks) ]
+    # the output image of the last frame (used with numpy).
+    self.block_frame = None
     return
 
-  # must return a string!
+  # must return bytes!
   def get_block_change(self, x, y):
     # okay, this function is going to be called millions of times.
     # so it must perform ultra-fast.
     '''get change of block (x,y)'''
     if not self.block_changed[y][x]:
-      return ''
+      return b''
     x0 = x*self.block_w
     y0 = self.out_height-(y+1)*self.block_h
     # if the block is partial, the player also expects a partial image.
@@ -252,10 +269,47 @@ class SWFVideoScreen(SWFBlockScreen):
     data = convert_image_to_string_rgb_flipped(self.get_image(x0, y0, w, h))
     hval = hash(data)
     if self.block_image[y][x] == hval:
-      return ''
+      return b''
     self.block_changed[y][x] = False
     self.block_image[y][x] = hval
     return bgr2rgb(data)
+
+  # returns the changes of all blocks in the order of VideoPacket
+  # (from the bottom row). Unchanged blocks are b''.
+  def get_block_changes(self):
+    if numpy is None:
+      return [ self.get_block_change(x, y)
+               for y in range(self.vblocks) for x in range(self.hblocks) ]
+    r = [b'']*(self.vblocks*self.hblocks)
+    changed = numpy.array(self.block_changed, dtype=bool)
+    if not changed.any():
+      return r
+    (bw, bh) = (self.block_w, self.block_h)
+    (width, height) = (self.out_width, self.out_height)
+    pixels = convert_image_to_pixels(self.out_buf)
+    if self.block_frame is None:
+      self.block_frame = pixels.copy()
+    else:
+      # compare the painted blocks with the last frame at once.
+      ys = numpy.nonzero(changed.any(axis=1))[0]
+      xs = numpy.nonzero(changed.any(axis=0))[0]
+      (by0, by1, bx0, bx1) = (ys[0], ys[-1]+1, xs[0], xs[-1]+1)
+      (top, bottom) = (lowerbound(0, height-by1*bh), height-by0*bh)
+      (left, right) = (bx0*bw, upperbound(width, bx1*bw))
+      diff = (pixels[top:bottom, left:right] !=
+              self.block_frame[top:bottom, left:right])[::-1]
+      diff = numpy.logical_or.reduceat(diff, numpy.arange(0, diff.shape[0], bh), axis=0)
+      diff = numpy.logical_or.reduceat(diff, numpy.arange(0, diff.shape[1], bw), axis=1)
+      changed[by0:by1, bx0:bx1] &= diff
+    frame = convert_image_to_array(self.out_buf)
+    for (y, x) in zip(*numpy.nonzero(changed)):
+      (y0, y1) = (lowerbound(0, height-(y+1)*bh), height-y*bh)
+      (x0, x1) = (x*bw, x*bw+bw)
+      self.block_frame[y0:y1, x0:x1] = pixels[y0:y1, x0:x1]
+      # flipped and BGR.
+      r[y*self.hblocks+x] = frame[y0:y1, x0:x1][::-1, :, ::-1].tobytes()
+    self.block_changed = [ [False]*self.hblocks for i in range(self.vblocks) ]
+    return r
   
   def paint_image(self, x0, y0, w, h, data):
     if not SWFScreen.paint_image(self, x0, y0, w, h, data): return False
@@ -275,6 +329,164 @@ class SWFVideoScreen(SWFBlockScreen):
     return True
   
 
+##  BlockCompressor
+##
+##  Compresses the blocks of a VideoPacket. zlib releases the GIL,
+##  so the changed blocks are split among a pool of threads.
+##  The result is in the same order.
+##
+##  Compressed blocks are also kept in a LRU cache by the digest of
+##  their content, so that a block that has been seen recently
+##  (at any position) is not compressed again.
+##
+def compress_block(data, prime=None):
+  if not prime:
+    return zlib.compress(data)
+  # ZlibPrimePrevious: the stream goes on after the prime,
+  # which the player has decompressed already.
+  z = zlib.compressobj()
+  z.compress(prime)
+  z.flush(zlib.Z_SYNC_FLUSH)
+  return z.compress(data)+z.flush()
+
+def compress_blocks(blocks):
+  return [ compress_block(data, prime) for (data, prime) in blocks ]
+
+class BlockCompressor:
+
+  def __init__(self, threads=None, cachesize=4096):
+    self.threads = threads or os.cpu_count() or 1
+    self.pool = None
+    if 1 < self.threads:
+      self.pool = ThreadPoolExecutor(self.threads)
+    # cachesize: the number of blocks (0: no cache).
+    self.cachesize = cachesize
+    self.cache = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    return
+
+  def get_stats(self):
+    return { 'hits': self.hits, 'misses': self.misses, 'cached': len(self.cache) }
+
+  # unchanged blocks (b'') stay empty.
+  # primes: the data which each block is primed with (see compress_block).
+  def compress(self, blocks, primes=None):
+    r = list(blocks)
+    primes = primes or [None]*len(blocks)
+    # {digest: [index, ...]} of the blocks to be compressed.
+    missed = {}
+    for (i, data) in enumerate(blocks):
+      if not data: continue
+      key = blake2b(data, digest_size=16).digest()
+      if primes[i]:
+        key += blake2b(primes[i], digest_size=16).digest()
+      if key in self.cache:
+        self.cache.move_to_end(key)
+        r[i] = self.cache[key]
+        self.hits += 1
+      elif key in missed:
+        # the same content twice in a frame (e.g. blank blocks).
+        missed[key].append(i)
+        self.hits += 1
+      else:
+        missed[key] = [i]
+        self.misses += 1
+    keys = list(missed)
+    args = [ (blocks[missed[key][0]], primes[missed[key][0]]) for key in keys ]
+    for (key, data) in zip(keys, self.compress_many(args)):
+      for i in missed[key]:
+        r[i] = data
+      if self.cachesize:
+        self.cache[key] = data
+    while self.cachesize < len(self.cache):
+      self.cache.popitem(last=False)
+    return r
+
+  def compress_many(self, blocks):
+    if self.pool and 1 < len(blocks):
+      n = (len(blocks)+self.threads-1)//self.threads
+      parts = [ blocks[j:j+n] for j in range(0, len(blocks), n) ]
+      return [ data for part in self.pool.map(compress_blocks, parts) for data in part ]
+    return compress_blocks(blocks)
+
+  def close(self):
+    if self.pool:
+      self.pool.shutdown()
+    return
+
+
+##  ScreenVideoMixin
+##
+##  The ScreenVideo codec of SWFVideoStream and FLVVideoStream.
+##    version 1: SCREENVIDEOPACKET (codec 3).
+##    version 2: SCREENV2VIDEOPACKET (codec 6). The blocks are in
+##      15/7 bit hybrid color with the default palette (BGR without
+##      numpy), and each block of an inter frame is primed with the
+##      same block of the last keyframe (ZlibPrimePrevious). A custom
+##      palette, IFrameImage and diff blocks are not used.
+##
+class ScreenVideoMixin:
+
+  screenvideo = 1                       # the default version
+
+  def open_video(self):
+    (x,y,w,h) = self.info.clipping
+    self.screen = SWFVideoScreen(x, y, w, h, self.info.blocksize, self.info.blocksize,
+                                 scaling=self.info.scaling)
+    self.compressor = BlockCompressor(self.info.threads)
+    self.codec = { 1:3, 2:6 }[self.info.screenvideo or self.screenvideo]
+    # the blocks of the last keyframe.
+    self.keyblocks = None
+    self.set_keyframe()
+    return
+
+  def set_keyframe(self):
+    self.screen.init_blocks()
+    self.is_keyframe = True
+    return
+
+  def write_video_packet(self, blocks):
+    (primes, colordepth) = (None, 0)
+    if self.codec == 6 and numpy is not None:
+      blocks = [ data and bgr2hybrid(data) for data in blocks ]
+      colordepth = 0x10
+    if self.is_keyframe:
+      self.writer.writebits(4, 1)
+      self.keyblocks = blocks
+      self.is_keyframe = False
+    else:
+      self.writer.writebits(4, 2)
+      if self.codec == 6:
+        primes = self.keyblocks
+    self.writer.writebits(4, self.codec)
+    self.writer.writebits(4, self.screen.block_w//16-1)
+    self.writer.writebits(12, self.screen.out_width)
+    self.writer.writebits(4, self.screen.block_h//16-1)
+    self.writer.writebits(12, self.screen.out_height)
+    self.writer.finishbits()
+    if self.codec == 6:
+      self.writer.writeui8(0)           # no IFrameImage nor palette
+    for (i, data) in enumerate(self.compressor.compress(blocks, primes)):
+      if not data:
+        self.writer.writeub16(0)
+      elif self.codec == 6:
+        self.writer.writeub16(len(data)+1)
+        # ColorDepth, ZlibPrimePrevious
+        self.writer.writeui8(colordepth | bool(primes and primes[i]))
+        self.writer.write(data)
+      else:
+        self.writer.writeub16(len(data))
+        self.writer.write(data)
+    return
+
+  def close_video(self):
+    self.compressor.close()
+    if self.debug:
+      print('stream: block cache stats: %r' % self.compressor.get_stats(), file=stderr)
+    return
+
+
 ##################################################################
 
 ##  MovieOutputStream
@@ -357,6 +569,9 @@ class SWFOutputStream(MovieOutputStream):
     self.writer = SWFWriter(self.info.filename, self.swf_version,
                             (0,self.info.width*20, 0,self.info.height*20),
                             self.info.framerate, self.info.compression)
+    # cursor shapes defined in this movie.
+    self.cursor_shapes = {}
+    self.cursor_shape_id = None
     # Write BGColor
     self.writer.start_tag()
     self.writer.writergb((255,255,255))
@@ -406,13 +621,13 @@ class SWFOutputStream(MovieOutputStream):
       self.writer.start_tag()
       self.writer.writeui16(nsamples)
       self.writer.writeui16(seeksamples)
-      self.writer.write(''.join(mp3frames))
+      self.writer.write(b''.join(mp3frames))
       self.writer.end_tag(19)
     return
 
   def define_shape(self, w, h, data, alpha=False):
     if self.debug:
-      print('define_shape:', (w,h), len(data), file=strerr)
+      print('define_shape:', (w,h), len(data), file=stderr)
     self.writer.start_tag()
     image_id = self.writer.newid()
     self.writer.writeui16(image_id)
@@ -484,7 +699,15 @@ class SWFOutputStream(MovieOutputStream):
         (w, h, dx, dy, data) = self.cursor_image
         self.cursor_image = None
         self.cursor_offset = (dx, dy)
-        shape_id = self.define_shape(w, h, data, alpha=True)
+        # a cursor shape that has been seen is not defined again.
+        key = (w, h, data)
+        if key not in self.cursor_shapes:
+          self.cursor_shapes[key] = self.define_shape(w, h, data, alpha=True)
+        shape_id = self.cursor_shapes[key]
+        if shape_id == self.cursor_shape_id:
+          shape_id = None
+        else:
+          self.cursor_shape_id = shape_id
       # shape_id is set when the cursor is changed.
       if shape_id or (self.cursor_offset and self.cursor_pos and self.cursor_pos0 != self.cursor_pos):
         if shape_id:
@@ -581,7 +804,7 @@ class SWFShapeStream(SWFOutputStream):
 
 ##  SWFVideoStream
 ##
-class SWFVideoStream(SWFOutputStream):
+class SWFVideoStream(ScreenVideoMixin, SWFOutputStream):
 
   """
   SWFVideoStream produces a SWF file with a video object.
@@ -589,11 +812,15 @@ class SWFVideoStream(SWFOutputStream):
   
   swf_version = 7                       # SWF7
 
+  def __init__(self, info, debug=0):
+    if (info.screenvideo or self.screenvideo) == 2:
+      self.swf_version = 9              # SWF9 for ScreenVideo V2
+    SWFOutputStream.__init__(self, info, debug)
+    return
+
   def open(self):
     SWFOutputStream.open(self)
-    (x,y,w,h) = self.info.clipping
-    self.screen = SWFVideoScreen(x, y, w, h, self.info.blocksize, self.info.blocksize,
-                                 scaling=self.info.scaling)
+    self.open_video()
     self.video_object = self.writer.newid()
     # write DefineVideoStream
     assert not self.writer.fpstack
@@ -609,10 +836,9 @@ class SWFVideoStream(SWFOutputStream):
     self.writer.writeui16(self.screen.out_width)
     self.writer.writeui16(self.screen.out_height)
     self.writer.writeui8(0)             # smoothing off
-    self.writer.writeui8(3)             # SCREENVIDEO
+    self.writer.writeui8(self.codec)    # SCREENVIDEO
     self.writer.end_tag(60)
     self.place_object2(self.video_object, 0, 0, 1)
-    self.set_keyframe()
     self.painted = False
     return
 
@@ -628,39 +854,15 @@ class SWFVideoStream(SWFOutputStream):
 
   def next_frame(self):
     if self.is_keyframe or self.painted:
-      r = []
-      changed = self.is_keyframe
       self.screen.prepare_image()
-      for y in range(self.screen.vblocks):
-        for x in range(self.screen.hblocks):
-          data = self.screen.get_block_change(x, y)
-          r.append(data)
-          if data:
-            changed = True
+      r = self.screen.get_block_changes()
+      changed = self.is_keyframe or any(r)
       if changed:
         # write VideoFrame tag
         self.writer.start_tag()
         self.writer.writeui16(self.video_object) # video char
         self.writer.writeui16(self.output_frames)
-        # SCREENVIDEOPACKET
-        if self.is_keyframe:
-          self.writer.writebits(4, 1)
-          self.is_keyframe = False
-        else:
-          self.writer.writebits(4, 2)
-        self.writer.writebits(4, 3) # screenvideo codec
-        self.writer.writebits(4, self.screen.block_w//16-1)
-        self.writer.writebits(12, self.screen.out_width)
-        self.writer.writebits(4, self.screen.block_h//16-1)
-        self.writer.writebits(12, self.screen.out_height)
-        self.writer.finishbits()
-        for data in r:
-          if data:
-            data = zlib.compress(data)
-            self.writer.writeub16(len(data))
-            self.writer.write(data)
-          else:
-            self.writer.writeub16(0)
+        self.write_video_packet(r)
         self.writer.end_tag(61)
         # PlaceObject2
         # For some reason we need to set the RATIO to the current frame number every time.
@@ -673,16 +875,12 @@ class SWFVideoStream(SWFOutputStream):
     SWFOutputStream.next_frame(self)
     return
 
-  def set_keyframe(self):
-    self.screen.init_blocks()
-    self.is_keyframe = True
-    return
-
   def close(self):
     assert not self.writer.fpstack
     self.writer.fp.seek(self.mangle_pos) # mangle this
     self.writer.writeui16(self.output_frames) # set the number of frames into DefineVideoStream tag.
     self.writer.fp.seek(0, 2) # go back
+    self.close_video()
     SWFOutputStream.close(self)
     return
 
@@ -827,13 +1025,14 @@ class MPEGVideoStream(MovieOutputStream):
 ##  FLVVideoStream
 ##  Contributed by Luis Fernando <lfkpoa-69@yahoo.com.br>
 ##
-class FLVVideoStream(MovieOutputStream):
+class FLVVideoStream(ScreenVideoMixin, MovieOutputStream):
 
   """
   FLVVideoStream produces a FLV file with a video object.
   """
   
   flv_version = 1                       # FLV 1
+  screenvideo = 2
 
   def __init__(self, info, debug=0):
     assert info.filename, 'Filename not specified!'
@@ -847,10 +1046,7 @@ class FLVVideoStream(MovieOutputStream):
                             (0,self.info.width*20, 0,self.info.height*20),
                             self.info.framerate)
     self.othertags = []
-    (x,y,w,h) = self.info.clipping
-    self.screen = SWFVideoScreen(x, y, w, h, self.info.blocksize, self.info.blocksize,
-                                 scaling=self.info.scaling)
-    self.set_keyframe()
+    self.open_video()
     return
 
   def paint_frame(self, xxx_todo_changeme9):
@@ -872,50 +1068,161 @@ class FLVVideoStream(MovieOutputStream):
     return
 
   def next_frame(self):
-    r = []
     self.screen.prepare_image(self.cursor_image, self.cursor_offset, self.cursor_pos)
-    for y in range(self.screen.vblocks):
-      for x in range(self.screen.hblocks):
-        r.append(self.screen.get_block_change(x, y))
+    r = self.screen.get_block_changes()
     # write FLV tag
     self.writer.start_tag()
-    # SCREENVIDEOPACKET
-    if self.is_keyframe:
-      self.writer.writebits(4, 1)
-      self.is_keyframe = False
-    else:
-      self.writer.writebits(4, 2)
-    self.writer.writebits(4, 3) # screenvideo codec
-    self.writer.writebits(4, self.screen.block_w//16-1)
-    self.writer.writebits(12, self.screen.out_width)
-    self.writer.writebits(4, self.screen.block_h//16-1)
-    self.writer.writebits(12, self.screen.out_height)
-    self.writer.finishbits()
-    for data in r:
-      if data:
-        data = zlib.compress(data)
-        self.writer.writeub16(len(data))
-        self.writer.write(data)
-      else:
-        self.writer.writeub16(0)
+    self.write_video_packet(r)
     # the first tag: always t == 0
     t = (self.output_frames*1000) // self.info.framerate
     self.writer.end_tag(9, t)
     MovieOutputStream.next_frame(self)
     return
 
-  def set_keyframe(self):
-    self.screen.init_blocks()
-    self.is_keyframe = True
-    return
-
   def close(self):
     assert not self.writer.fpstack
+    self.close_video()
     MovieOutputStream.close(self)
     self.writer.write_file(self.output_frames)
     return
 
 
+##  ThreadedOutputStream
+##
+##  Runs another MovieOutputStream in its own thread so that the
+##  encoding does not hold up the receiving of updates. Frames are
+##  passed through a queue of the given depth. When the queue is full:
+##    block: waits for the encoder.
+##    merge: the frame is folded into the last queued one. Both are
+##           painted at once at the time of the latter, so that the
+##           length of the movie is kept.
+##    drop:  like merge, but the folded frame is not output at all.
+##           The movie gets shorter than the recording.
+##
+class ThreadedOutputStream(MovieOutputStream):
+
+  POLICIES = ('block', 'merge', 'drop')
+
+  def __init__(self, stream, depth=8, policy='block', debug=0):
+    assert policy in self.POLICIES, 'Invalid queue policy: %r' % policy
+    MovieOutputStream.__init__(self, stream.info, debug)
+    self.stream = stream
+    self.depth = max(1, depth)
+    self.policy = policy
+    self.queue = deque()
+    self.cond = threading.Condition()
+    self.paints = []
+    self.thread = None
+    self.error = None
+    # statistics
+    self.max_depth = 0
+    self.merged_frames = 0
+    self.dropped_frames = 0
+    self.blocked_time = 0.0
+    self.lag = 0.0
+    self.max_lag = 0.0
+    return
+
+  def get_stats(self):
+    return { 'depth': len(self.queue), 'max_depth': self.max_depth,
+             'merged': self.merged_frames, 'dropped': self.dropped_frames,
+             'blocked': self.blocked_time, 'lag': self.lag, 'max_lag': self.max_lag }
+
+  def put(self, item):
+    with self.cond:
+      self.queue.append(item)
+      self.max_depth = max(self.max_depth, len(self.queue))
+      self.cond.notify_all()
+    return
+
+  # item: ['frame', paints, nframes, time]
+  def put_frame(self, paints):
+    t = time.time()
+    with self.cond:
+      while self.depth <= len(self.queue) and not self.error:
+        last = self.queue[-1]
+        if self.policy != 'block' and last[0] == 'frame':
+          last[1].extend(paints)
+          if self.policy == 'merge':
+            last[2] += 1
+            self.merged_frames += 1
+          else:
+            self.dropped_frames += 1
+          return
+        self.cond.wait()
+      self.blocked_time += time.time() - t
+    self.put(['frame', paints, 1, t])
+    return
+
+  def run(self):
+    while 1:
+      with self.cond:
+        while not self.queue:
+          self.cond.wait()
+        item = self.queue.popleft()
+        self.cond.notify_all()
+      if item[0] == 'close':
+        break
+      if self.error:
+        continue
+      try:
+        if item[0] == 'open':
+          self.stream.open()
+        elif item[0] == 'keyframe':
+          self.stream.set_keyframe()
+        else:
+          (_, paints, nframes, t) = item
+          for i in range(nframes-1):
+            self.stream.next_frame()
+          for frame in paints:
+            self.stream.paint_frame(frame)
+          self.stream.next_frame()
+          self.lag = time.time() - t
+          self.max_lag = max(self.max_lag, self.lag)
+      except Exception as e:
+        # the rest is discarded, so that the receiver never waits forever.
+        print('stream: encoder error:', e, file=stderr)
+        with self.cond:
+          self.error = e
+          self.cond.notify_all()
+    return
+
+  def open(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    self.put(('open',))
+    return
+
+  def set_keyframe(self):
+    self.put(('keyframe',))
+    return
+
+  def paint_frame(self, frame):
+    MovieOutputStream.paint_frame(self, frame)
+    self.paints.append(frame)
+    return
+
+  def next_frame(self):
+    MovieOutputStream.next_frame(self)
+    self.put_frame(self.paints)
+    self.paints = []
+    return
+
+  def close(self):
+    if self.thread:
+      self.put(('close',))
+      self.thread.join()
+      self.thread = None
+      if not self.error:
+        self.stream.close()
+    if self.debug:
+      print('stream: queue stats: %r' % self.get_stats(), file=stderr)
+    if self.error:
+      raise self.error
+    return
+
+
 ##  StreamFactory
 ##
 def StreamFactory(type):
@@ -232,7 +232,7 @@ def play(moviefiles, info, debug=0):
     elif fname.endswith('.flv'):
       # flv file
       movie.parse_flv(fname, True, debug=debug)
-    elif fname.endswith('.vnc'):
+    elif fname.endswith('.vnc') or fname.endswith('.vncz'):
       # vncrec file
       movie.parse_vncrec(fname, debug=debug)
     else:
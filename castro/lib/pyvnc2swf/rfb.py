@@ -26,30 +26,396 @@
 # For the details of RFB protocol,
 # see http://www.realvnc.com/docs/rfbproto.pdf
 
-import sys, time, socket
-from struct import pack, unpack
+import sys, os, time, socket, selectors, zlib, asyncio, mmap
+from struct import pack, unpack, iter_unpack
+from io import BytesIO
 from .d3des import decrypt_passwd, generate_response
-from .image import IMG_SOLID, IMG_RAW
+from .vncrec import read_index, write_index, ZLOG_MAGIC, VncRecZWriter, VncRecZReader
+from .image import IMG_SOLID, IMG_RAW, IMG_COPYRECT, create_image_from_jpeg, \
+     imgsize, convert_image_to_string_rgb
 # JRH - castro - begin
 from .. import messageboard as mb
 # JRH - castro - end
+try:
+  # numpy is optional (see tight_gradient).
+  import numpy
+except ImportError:
+  numpy = None
 stderr = sys.stderr
 lowerbound = max
 
 
-def byte2bit(s):
-  return ''.join([ chr((ord(s[i>>3]) >> (7 - i&7)) & 1) for i in range(len(s)*8) ])
+# Encodings that can be specified by name.
+ENCODINGS = {
+  'raw': 0,
+  'copyrect': 1,
+  'rre': 2,
+  'corre': 4,
+  'hextile': 5,
+  'zlib': 6,
+  'tight': 7,
+  'zlibhex': 8,
+  'zrle': 16,
+  }
+# Tight JPEG quality levels and compression levels (pseudo-encodings).
+for _i in range(10):
+  ENCODINGS['quality%d' % _i] = -32+_i
+  ENCODINGS['compress%d' % _i] = -256+_i
+
+
+# Pixel formats that can be specified by name.
+#   (bitsperpixel, depth, bigendian, truecolour,
+#    red_max, green_max, blue_max, red_shift, green_shift, blue_shift)
+PIXEL_FORMATS = {
+  'rgb888': (32, 8, 1, 1, 255, 255, 255, 24, 16, 8),
+  'rgb565': (16, 16, 0, 1, 31, 63, 31, 11, 5, 0),
+  'rgb555': (16, 15, 0, 1, 31, 31, 31, 10, 5, 0),
+  'bgr233': (8, 8, 0, 1, 7, 7, 3, 0, 3, 6),
+  'cmap8': (8, 8, 0, 0, 0, 0, 0, 0, 0, 0),
+  }
+
+
+# pixel_converter: returns a function that converts pixels into RGB.
+#   Each color is looked up from each byte of the pixels with
+#   bytes.translate (and the parts are ORed), so that no pixel
+#   is handled one by one.
+def pixel_converter(bitsperpixel, bigendian, maxes, shifts):
+  nbytes = bitsperpixel//8
+  identity = bytes(range(256))
+  channels = []
+  for (cmax, shift) in zip(maxes, shifts):
+    bits = cmax.bit_length()
+    if cmax != (1<<bits)-1 or 8 < bits:
+      raise RFBProtocolError('Unsupported color max: %d' % cmax)
+    planes = []
+    for k in range(nbytes):
+      if bigendian:
+        j = nbytes-1-k
+      else:
+        j = k
+      table = bytes([ (((b << 8*j) >> shift) & cmax) << (8-bits) for b in range(256) ])
+      if table == identity:
+        planes.append((k, None))
+      elif any(table):
+        planes.append((k, table))
+    # scale the values to 0-255.
+    scale = None
+    if 0 < bits < 8:
+      scale = bytes([ (v >> (8-bits))*255//cmax for v in range(256) ])
+    channels.append((planes, scale))
+  def convert(data):
+    data = bytes(data)
+    n = len(data)//nbytes
+    out = bytearray(n*3)
+    for (c, (planes, scale)) in enumerate(channels):
+      values = None
+      for (k, table) in planes:
+        v = data[k::nbytes].translate(table)
+        if values is None:
+          values = v
+        else:
+          values = (int.from_bytes(values, 'big') | int.from_bytes(v, 'big')).to_bytes(n, 'big')
+      if values is None: continue
+      if scale:
+        values = values.translate(scale)
+      out[c::3] = values
+    return bytes(out)
+  return convert
+
+# colourmap_converter: returns a function that converts 8-bit
+#   colour map indices into RGB. colourmap is a list of three
+#   (mutable) tables, which are updated by SetColourMapEntries.
+def colourmap_converter(colourmap):
+  def convert(data):
+    data = bytes(data)
+    out = bytearray(len(data)*3)
+    for c in range(3):
+      out[c::3] = data.translate(colourmap[c])
+    return bytes(out)
+  return convert
+
+
+# cpixel_format: returns (size, offset) of the compact pixels (ZRLE CPIXEL).
+#   A 32-bit pixel whose colors fit in three bytes is sent with three bytes.
+#   offset is the position of these three bytes within the full pixel.
+def cpixel_format(bitsperpixel, depth, bigendian, truecolour,
+                  red_max, green_max, blue_max,
+                  red_shift, green_shift, blue_shift):
+  if not (bitsperpixel == 32 and depth <= 24 and truecolour):
+    return (bitsperpixel//8, 0)
+  mask = (red_max << red_shift) | (green_max << green_shift) | (blue_max << blue_shift)
+  (ls3bytes, ms3bytes) = (mask < (1<<24), (mask & 0xff) == 0)
+  if (ls3bytes and not bigendian) or (ms3bytes and bigendian):
+    return (3, 0)
+  if (ls3bytes and bigendian) or (ms3bytes and not bigendian):
+    return (3, 1)
+  return (4, 0)
+
+# expand_cpixels: inserts the padding bytes into 3-byte compact pixels.
+def expand_cpixels(data, offset):
+  out = bytearray(len(data)//3*4)
+  for k in range(3):
+    out[offset+k::4] = data[k::3]
+  return out
+
+# unpack_indices: expands packed palette indices (MSB first, each row padded
+#   to a byte boundary) into one byte per pixel.
+def _index_table(bits):
+  mask = (1<<bits)-1
+  return [ bytes([ (b >> (8-bits*(i+1))) & mask for i in range(8//bits) ])
+           for b in range(256) ]
+INDEX_TABLES = { 1: _index_table(1), 2: _index_table(2), 4: _index_table(4) }
+def unpack_indices(data, bits, width, height):
+  if bits == 8:
+    return bytes(data)
+  table = INDEX_TABLES[bits]
+  rowbytes = (width*bits+7)//8
+  return b''.join([ b''.join(map(table.__getitem__, data[p:p+rowbytes]))[:width]
+                    for p in range(0, rowbytes*height, rowbytes) ])
+
+# lookup_pixels: converts one-byte indices into pixels of the palette.
+def lookup_pixels(indices, palette, bytesperpixel):
+  out = bytearray(len(indices)*bytesperpixel)
+  for k in range(bytesperpixel):
+    table = bytes([ c[k] for c in palette ]).ljust(256, b'\x00')
+    out[k::bytesperpixel] = indices.translate(table)
+  return out
+
+
+# tpixel_size: returns the size of the Tight pixels (TPIXEL).
+#   A 24-bit color in a 32-bit pixel is sent as three bytes of R, G, B.
+def tpixel_size(bitsperpixel, depth, bigendian, truecolour,
+                red_max, green_max, blue_max,
+                red_shift, green_shift, blue_shift):
+  if (bitsperpixel == 32 and depth == 24 and truecolour and
+      red_max == green_max == blue_max == 255):
+    return 3
+  return bitsperpixel//8
+
+# tight_gradient: reverses the Tight gradient filter.
+#   src and the returned list are the color components of each pixel
+#   (r,g,b,r,g,b,...) and each component is predicted from its neighbors.
+def tight_gradient(src, width, height, maxes):
+  # numpy takes a step per diagonal, which does not pay off
+  # for small or thin rectangles.
+  if numpy is not None and 64 <= min(width, height):
+    return tight_gradient_numpy(src, width, height, maxes)
+  rowlen = width*3
+  out = [0]*(rowlen*height)
+  prev = [0]*rowlen
+  for i in range(0, rowlen*height, rowlen):
+    for c in range(3):
+      out[i+c] = (prev[c] + src[i+c]) & maxes[c]
+    for x in range(3, rowlen):
+      m = maxes[x % 3]
+      est = prev[x] + out[i+x-3] - prev[x-3]
+      if m < est:
+        est = m
+      elif est < 0:
+        est = 0
+      out[i+x] = (est + src[i+x]) & m
+    prev = out[i:i+rowlen]
+  return out
+
+# A pixel depends on its left, upper and upper-left neighbors, so the
+# pixels on each anti-diagonal (x+y = d) are predicted at once. The image is
+# skewed so that pixel (x,y) is at out[y+1, x+y+1] and each diagonal is a
+# column. The zeros around it are the neighbors outside the rectangle.
+def tight_gradient_numpy(src, width, height, maxes):
+  if isinstance(src, (bytes, bytearray)):
+    src = numpy.frombuffer(src, dtype=numpy.uint8)
+  src = numpy.asarray(src, dtype=numpy.int32).reshape(height, width, 3)
+  maxes = numpy.array(maxes, dtype=numpy.int32)
+  skew = numpy.zeros((height, width+height-1, 3), dtype=numpy.int32)
+  for y in range(height):
+    skew[y, y:y+width] = src[y]
+  out = numpy.zeros((height+1, width+height, 3), dtype=numpy.int32)
+  for d in range(width+height-1):
+    (y0, y1) = (max(0, d-width+1), min(d, height-1)+1)
+    # left + upper - upper-left (the column -1 is zero when d = 0).
+    est = out[y0+1:y1+1, d] + out[y0:y1, d] - out[y0:y1, d-1]
+    numpy.clip(est, 0, maxes, out=est)
+    out[y0+1:y1+1, d+1] = (est + skew[y0:y1, d]) & maxes
+  return numpy.concatenate([ out[y+1, y+1:y+1+width] for y in range(height) ]).reshape(-1).tolist()
+
+
+# cursor_image: composes an ARGB cursor image.
+#   colors are the R, G and B values of each pixel and
+#   mask has 1 bit/pixel (1 -> opaque; 0 -> transparent).
+CURSOR_ALPHA = bytes([0, 255]).ljust(256, b'\x00')
+def cursor_image(width, height, colors, mask):
+  alpha = unpack_indices(mask, 1, width, height).translate(CURSOR_ALPHA)
+  n = len(alpha)
+  a = int.from_bytes(alpha, 'big')
+  out = bytearray(n*4)
+  out[0::4] = alpha
+  for (c, plane) in enumerate(colors):
+    # transparent pixels are (0,0,0,0).
+    out[c+1::4] = (int.from_bytes(plane, 'big') & a).to_bytes(n, 'big')
+  return bytes(out)
 
 
 # Exceptions
 class RFBError(Exception): pass
 class RFBAuthError(RFBError): pass
 class RFBProtocolError(RFBError): pass
+class RFBInterrupted(RFBError): pass
+
+
 
+##  RFBStats
+##
+##  Transport statistics of an RFB client: bytes, rects, subrects and
+##  decode time per encoding, the round-trip time of update requests
+##  and the update rate. If interval is given, they are written to fp
+##  every interval seconds (labelled with name, if any).
+##  The decode time includes the time spent waiting for the data.
+##
+ENCODING_NAMES = dict( (v,k) for (k,v) in ENCODINGS.items() if 0 <= v )
+ENCODING_NAMES.update({ -239: 'richcursor', -240: 'xcursor', -232: 'cursorpos' })
+
+class RFBStats:
+
+  def __init__(self, interval=0, fp=stderr, name=None):
+    self.interval = interval
+    self.fp = fp
+    self.name = name
+    self.reset()
+    return
+
+  def reset(self):
+    self.t0 = self.last_dump = time.perf_counter()
+    # encoding -> [rects, subrects, bytes, decode time]
+    self.encodings = {}
+    self.updates = self.last_updates = 0
+    self.requested = None
+    self.rtt_count = 0
+    self.rtt_total = 0.0
+    self.rtt_max = 0.0
+    return
+
+  def request_sent(self):
+    self.requested = time.perf_counter()
+    return
+
+  def update_received(self):
+    if self.requested is not None:
+      rtt = time.perf_counter() - self.requested
+      self.requested = None
+      self.rtt_count += 1
+      self.rtt_total += rtt
+      self.rtt_max = max(self.rtt_max, rtt)
+    return
+
+  def add_rect(self, encoding, nbytes, nsubrects, dt):
+    try:
+      e = self.encodings[encoding]
+    except KeyError:
+      e = self.encodings[encoding] = [0, 0, 0, 0.0]
+    e[0] += 1
+    e[1] += nsubrects
+    e[2] += nbytes
+    e[3] += dt
+    return
+
+  def update_done(self):
+    self.updates += 1
+    if self.interval and self.last_dump + self.interval <= time.perf_counter():
+      self.dump()
+    return
+
+  def get_stats(self):
+    "Returns the statistics since the last reset() as a dict."
+    t = time.perf_counter() - self.t0
+    return {
+      'time': t,
+      'updates': self.updates,
+      'updates_per_sec': self.updates / t if t else 0.0,
+      'rtt_avg': self.rtt_total / self.rtt_count if self.rtt_count else 0.0,
+      'rtt_max': self.rtt_max,
+      'encodings': dict( (ENCODING_NAMES.get(k, str(k)),
+                          { 'rects': rects, 'subrects': subrects,
+                            'bytes': nbytes, 'decode_time': dt })
+                         for (k, (rects, subrects, nbytes, dt)) in self.encodings.items() ),
+      }
+
+  def dump(self):
+    t = time.perf_counter()
+    rate = (self.updates - self.last_updates) / (t - self.last_dump)
+    (self.last_dump, self.last_updates) = (t, self.updates)
+    stats = self.get_stats()
+    print('RFB stats%s: %.1f updates/s (total %d), rtt avg=%.1fms max=%.1fms' %
+          (' (%s)' % self.name if self.name else '', rate,
+           stats['updates'], stats['rtt_avg']*1000, stats['rtt_max']*1000), file=self.fp)
+    for (name, e) in sorted(stats['encodings'].items()):
+      print('  %s: rects=%d, subrects=%d, bytes=%d, decode=%.1fms' %
+            (name, e['rects'], e['subrects'], e['bytes'], e['decode_time']*1000), file=self.fp)
+    return
+
+
+##  RFBEncodingTuner
+##
+##  Chooses the encoding at the beginning of a session: each candidate
+##  is tried with a full refresh of the screen, and the one that takes
+##  the least time from the request to the decoded update (transfer
+##  plus decoding) is used for the rest of the session. Candidates that
+##  are much slower than the best one are not tried again.
+##
+class RFBEncodingTuner:
+
+  CANDIDATES = (0, 5, 16, 7)            # raw, hextile, zrle, tight
+
+  def __init__(self, candidates=CANDIDATES, rounds=2):
+    self.candidates = tuple(candidates)
+    self.rounds = rounds
+    self.reset()
+    return
+
+  def reset(self):
+    self.probes = list(self.candidates)
+    self.round = 1
+    self.encoding = self.probes[0]
+    # encoding -> [time, cpu time, bytes] of the best probe.
+    self.results = {}
+    self.probing = True
+    return
+
+  def get_encodings(self):
+    if self.encoding == 1:
+      return (1,)
+    return (self.encoding, 1)
+
+  def start_probe(self, received):
+    self.encoding = self.probes[0]
+    self.probe = (time.perf_counter(), received)
+    return
+
+  def probe_done(self, received, cpu):
+    (t0, received0) = self.probe
+    result = [time.perf_counter()-t0, cpu, received-received0]
+    encoding = self.probes.pop(0)
+    if encoding not in self.results or result[0] < self.results[encoding][0]:
+      self.results[encoding] = result
+    if not self.probes and self.round < self.rounds:
+      self.round += 1
+      best = min( t for (t,_,_) in self.results.values() )
+      self.probes = [ e for e in self.candidates if self.results[e][0] < best*2 ]
+    if not self.probes:
+      self.probing = False
+      self.encoding = min(self.results, key=lambda e: self.results[e][0])
+    return
+
+  def __repr__(self):
+    return ', '.join( '%s=%.1fms/%.1fms/%dbytes' % (ENCODING_NAMES.get(e, e), t*1000, cpu*1000, nbytes)
+                      for (e, (t, cpu, nbytes)) in self.results.items() )
 
 
 ##  RFBFrameBuffer
 ##
+##  The data given to process_pixels/process_solid/change_cursor may be
+##  a memoryview into the receive buffer of the client, which is only
+##  valid during the call. Copy it if it needs to be kept.
+##
 class RFBFrameBuffer:
 
   def init_screen(self, width, height, name):
@@ -69,18 +435,38 @@ class RFBFrameBuffer:
     #print >>stderr, 'process_solid: %dx%d at (%d,%d), color=%r' % (width,height,x,y, color)
     raise NotImplementedError
 
+  # copies the (sx,sy)-(sx+width,sy+height) area of the current screen.
+  # returns True if the source is not available (the area is requested again).
+  def copy_rect(self, sx, sy, x, y, width, height):
+    #print >>stderr, 'copy_rect: %dx%d from (%d,%d) to (%d,%d)' % (width,height,sx,sy,x,y)
+    raise NotImplementedError
+
+  # data is given as RGB (Tight JPEG etc.)
+  def process_rgb(self, x, y, width, height, data):
+    #print >>stderr, 'process_rgb: %dx%d at (%d,%d)' % (width,height,x,y)
+    raise NotImplementedError
+
   def update_screen(self, t):
     #print >>stderr, 'update_screen'
     raise NotImplementedError
 
+  # returns the time when the next output frame starts.
+  def next_frame_time(self, t):
+    return t
+
   # data is given as ARGB
-  def change_cursor(self, width, height, data):
+  def change_cursor(self, width, height, dx, dy, data):
     #print >>stderr, 'change_cursor'
     raise NotImplementedError
 
   def move_cursor(self, x, y):
     #print >>stderr, 'move_cursor'
     raise NotImplementedError
+
+  # called before the colour map changes: the pixels kept so far
+  # should be converted with the old colours.
+  def change_colourmap(self):
+    return
  
   def close(self):
     return
@@ -91,31 +477,73 @@ class RFBFrameBuffer:
 class RFBProxy:
   "Abstract class of RFB clients."
 
-  def __init__(self, fb=None, pwdfile=None, preferred_encoding=(5,0), debug=0):
+  def __init__(self, fb=None, pwdfile=None, preferred_encoding=(5,0), debug=0,
+               pixel_format=None, throttle=None, stats=None, tuner=None):
     self.fb = fb
     self.debug = debug
     self.pwdfile = pwdfile
     self.pwdcache = None
     self.preferred_encoding = preferred_encoding
+    self.pixel_format = pixel_format
+    self.colourmap = [ bytearray(256), bytearray(256), bytearray(256) ]
+    self.cursor_cache = {}
+    self.update_pending = False
+    self.continuous = False
+    self.interrupted = False
+    # throttle: if not None, an update is requested only when the next
+    # output frame is due (this many seconds before it).
+    self.throttle = throttle
+    self.next_request = 0
+    # stats: RFBStats or None. received: bytes received so far.
+    self.stats = stats
+    self.received = 0
+    # tuner: RFBEncodingTuner or None (the encodings are chosen automatically).
+    self.tuner = tuner
+    # the number of connections made (start() called) so far.
+    self.sessions = 0
     return
 
-  FASTEST_FORMAT = (32, 8, 1, 1, 255, 255, 255, 24, 16, 8)
+  FASTEST_FORMAT = PIXEL_FORMATS['rgb888']
   def preferred_format(self, bitsperpixel, depth, bigendian, truecolour,
                        red_max, green_max, blue_max,
                        red_shift, green_shift, blue_shift):
     # should return 10-tuple (bitsperpixel, depth, bigendian, truecolour,
     #   red_max, green_max, blue_max, red_shift, green_shift, blue_shift)
-    if self.fb:
-      self.fb.set_converter(lambda data: data,
+    pixelformat = PIXEL_FORMATS[self.pixel_format or 'rgb888']
+    self.set_converter(*pixelformat)
+    return pixelformat
+
+  def set_converter(self, bitsperpixel, depth, bigendian, truecolour,
+                    red_max, green_max, blue_max,
+                    red_shift, green_shift, blue_shift):
+    "Sets the converters of the frame buffer for the given pixel format."
+    if not self.fb:
+      return
+    if (bitsperpixel, depth, bigendian, truecolour,
+        red_max, green_max, blue_max,
+        red_shift, green_shift, blue_shift) == self.FASTEST_FORMAT:
+      self.fb.set_converter(bytes,
                             lambda data: unpack('BBBx', data))
-    return self.FASTEST_FORMAT
+      return
+    if bitsperpixel not in (8, 16, 32):
+      raise RFBProtocolError('Unsupported bitsperpixel: %d' % bitsperpixel)
+    if truecolour:
+      convert = pixel_converter(bitsperpixel, bigendian,
+                                (red_max, green_max, blue_max),
+                                (red_shift, green_shift, blue_shift))
+    elif bitsperpixel == 8:
+      convert = colourmap_converter(self.colourmap)
+    else:
+      raise RFBProtocolError('Unsupported colour map: %d bits' % bitsperpixel)
+    self.fb.set_converter(convert, lambda data: tuple(convert(data)))
+    return
   
   def send(self, s):
     "Send data s to the server."
     raise NotImplementedError
 
   def recv(self, n):
-    "Receive n-bytes data from the server."
+    "Receive n-bytes data from the server (valid until the next recv)."
     raise NotImplementedError
 
   def recv_relay(self, n):
@@ -123,14 +551,70 @@ class RFBProxy:
     return self.recv(n)
 
   def recv_byte_with_timeout(self):
+    "Receive the next message type, or None if nothing has arrived yet."
     return self.recv_relay(1)
 
+  def pause(self, timeout):
+    "Wait for timeout seconds. Returns True if the server has sent something."
+    time.sleep(timeout)
+    return False
+
   def write(self, n):
     return
+
+  def reset_decoders(self):
+    "Resets the per-connection decoder states (zlib streams)."
+    self.zlib_stream = zlib.decompressobj()
+    self.zlibhex_streams = [ zlib.decompressobj(), zlib.decompressobj() ]
+    self.zrle_stream = zlib.decompressobj()
+    self.tight_streams = [ zlib.decompressobj() for i in range(4) ]
+    # the decoded cursors depend on the pixel format.
+    self.cursor_cache.clear()
+    return
+
+  def save_decoders(self):
+    "Returns a copy of the decoder states."
+    return (self.zlib_stream.copy(), [ z.copy() for z in self.zlibhex_streams ],
+            self.zrle_stream.copy(), [ z.copy() for z in self.tight_streams ])
+
+  def restore_decoders(self, state):
+    "Restores the decoder states saved by save_decoders."
+    (zlib_stream, zlibhex_streams, zrle_stream, tight_streams) = state
+    self.zlib_stream = zlib_stream.copy()
+    self.zlibhex_streams = [ z.copy() for z in zlibhex_streams ]
+    self.zrle_stream = zrle_stream.copy()
+    self.tight_streams = [ z.copy() for z in tight_streams ]
+    return
+
+  # the decoded cursor shapes are kept (animated cursors repeat them).
+  CURSOR_CACHE_SIZE = 64
+  def cache_cursor(self, key, data):
+    if self.CURSOR_CACHE_SIZE <= len(self.cursor_cache):
+      self.cursor_cache.clear()
+    self.cursor_cache[key] = data
+    return
+
+  def get_encodings(self):
+    "Returns the encodings (including pseudo encodings) sent by SetEncodings."
+    if self.tuner:
+      return self.tuner.get_encodings() + tuple([ e for e in self.preferred_encoding if e < 0 ])
+    return tuple(self.preferred_encoding)
+
+  def send_encodings(self):
+    encodings = self.get_encodings()
+    self.send(b'\x02\x00' + pack('>H', len(encodings)) +
+              b''.join([ pack('>l', e) for e in encodings ]))
+    return
   
-  def request_update(self):
+  def request_update(self, incremental=True):
     "Send a request to the server."
     raise NotImplementedError
+  def request_refresh(self, x, y, width, height):
+    "Request a non-incremental update of the given area."
+    return
+  def start_continuous_updates(self):
+    "Called when the server supports ContinuousUpdates."
+    return
   def finish_update(self):
     if self.fb:
       self.fb.update_screen(time.time())
@@ -138,7 +622,7 @@ class RFBProxy:
   
   def init(self):
     # recv: server protocol version
-    server_version = self.recv(12)
+    server_version = bytes(self.recv(12))
     # send: client protocol version
     self.protocol_version = 3
     if server_version.startswith(b'RFB 003.007'):
@@ -168,7 +652,7 @@ class RFBProxy:
       if not p:
         raise RFBError('Auth cancelled')
       # from pyvncviewer
-      challange = self.recv(16)
+      challange = bytes(self.recv(16))
       if self.debug:
         print('challange: %r' % challange, file=stderr)
       response = generate_response(p, challange)
@@ -189,7 +673,7 @@ class RFBProxy:
       # server_security might be 0, 1 or 2.
       if server_security == 0:
         (reason_length,) = unpack('>L', self.recv(4))
-        reason = self.recv(reason_length)
+        reason = bytes(self.recv(reason_length))
         raise RFBAuthError('Auth Error: %s' % reason)
       elif server_security == 1:
         pass
@@ -199,7 +683,7 @@ class RFBProxy:
       # protocol 3.7 or 3.8
       # recv: multiple server securities
       (nsecurities,) = unpack('>B', self.recv(1))
-      server_securities = self.recv(nsecurities)
+      server_securities = bytes(self.recv(nsecurities))
       if self.debug:
         print('server_securities: %r' % server_securities, file=stderr)
       # must include None or VNCAuth
@@ -222,7 +706,7 @@ class RFBProxy:
       # auth failed.
       if self.protocol_version != 3:
         (reason_length,) = unpack('>L', self.recv(4))
-        reason = self.recv(reason_length)
+        reason = bytes(self.recv(reason_length))
       else:
         reason = server_result
       raise RFBAuthError('Auth Error: %s' % reason)
@@ -237,7 +721,7 @@ class RFBProxy:
     # server info.
     server_init = self.recv(24)
     (width, height, pixelformat, namelen) = unpack('>HH16sL', server_init)
-    self.name = self.recv(namelen)
+    self.name = bytes(self.recv(namelen))
     (bitsperpixel, depth, bigendian, truecolour,
      red_max, green_max, blue_max,
      red_shift, green_shift, blue_shift) = unpack('>BBBBHHHBBBxxx', pixelformat)
@@ -256,201 +740,215 @@ class RFBProxy:
                                                                  red_max, green_max, blue_max,
                                                                  red_shift, green_shift, blue_shift)
     self.bytesperpixel = bitsperpixel//8
+    self.pixelformat = (bitsperpixel, depth, bigendian, truecolour,
+                        red_max, green_max, blue_max,
+                        red_shift, green_shift, blue_shift)
+    self.cpixel = cpixel_format(*self.pixelformat)
+    self.tpixel = tpixel_size(*self.pixelformat)
     pixelformat = pack('>BBBBHHHBBBxxx', bitsperpixel, depth, bigendian, truecolour,
                        red_max, green_max, blue_max,
                        red_shift, green_shift, blue_shift)
     self.send(pixelformat)
-    self.write(pack('>HH16sL', width, height, pixelformat, namelen))
-    self.write(self.name)
+    if not self.sessions:
+      # a resumed session goes on in the same recording.
+      self.write(pack('>HH16sL', width, height, pixelformat, namelen))
+      self.write(self.name)
+    self.sessions += 1
     if self.fb:
       self.clipping = self.fb.init_screen(width, height, self.name)
     else:
       self.clipping = (0,0, width, height)
-    self.send(b'\x02\x00' + pack('>H', len(self.preferred_encoding)))
-    for e in self.preferred_encoding:
-      self.send(pack('>l', e))
+    self.send_encodings()
+    self.reset_requests()
+    self.reset_decoders()
     return self
+
+  def reset_requests(self):
+    "Forgets the outstanding update request (the start of a session)."
+    self.update_pending = False
+    # the first update of a connection is always a full one.
+    self.incremental = False
+    self.continuous = False
+    self.next_request = 0
+    return
   
   def loop1(self):
-    self.request_update()
+    # Keep exactly one update request outstanding.
+    # (With ContinuousUpdates, the server sends updates by itself.)
+    if not self.update_pending:
+      delay = self.next_request - time.time()
+      if 0 < delay:
+        # throttled: the next output frame is not due yet.
+        if not self.pause(delay):
+          return True
+      elif self.tuner and self.tuner.probing:
+        # try the next encoding with the whole screen.
+        self.tuner.start_probe(self.received)
+        self.send_encodings()
+        self.request_refresh(*self.clipping)
+        self.update_pending = True
+        self.incremental = True
+      else:
+        self.request_update(self.incremental)
+        self.update_pending = True
+        self.incremental = True
+        if self.stats:
+          self.stats.request_sent()
     c = self.recv_byte_with_timeout()
-    if c == '':
-      return False
-    elif c == None:
-      # timeout
+    if c is None:
+      # timeout or interrupted
       pass
     elif c == b'\x00':
+      stats = self.stats
+      if stats:
+        stats.update_received()
+      cpu = time.thread_time()
       (nrects,) = unpack('>xH', self.recv_relay(3))
-      if self.debug:
-        print('FrameBufferUpdate: nrects=%d' % nrects, file=stderr)
+      # the CopyRect destinations whose source was not available.
+      lost = []
       for rectindex in range(nrects):
+        if stats:
+          (pos, t0, nsubrects) = (self.received, time.perf_counter(), 0)
         (x0, y0, width, height, t) = unpack('>HHHHl', self.recv_relay(12))
-        if self.debug:
-          print(' %d: %d x %d at (%d,%d), type=%d' % (rectindex, width, height, x0, y0, t), file=stderr)
         # RawEncoding
         if t == 0:
           l = width*height*self.bytesperpixel
           data = self.recv_relay(l)
-          if self.debug:
-            print(' RawEncoding: len=%d, received=%d' % (l, len(data)), file=stderr)
           if self.fb:
             self.fb.process_pixels(x0, y0, width, height, data)
         # CopyRectEncoding
         elif t == 1:
-          raise RFBProtocolError('unsupported: CopyRectEncoding')
+          (sx, sy) = unpack('>HH', self.recv_relay(4))
+          if self.fb:
+            (cx, cy, cw, ch) = self.clipping
+            if (self.fb.copy_rect(sx, sy, x0, y0, width, height) or
+                not (cx <= sx and cy <= sy and sx+width <= cx+cw and sy+height <= cy+ch)):
+              # the source is not in the frame buffer. get the real pixels.
+              lost.append((x0, y0, width, height))
         # RREEncoding
         elif t == 2:
           (nsubrects,) = unpack('>L', self.recv_relay(4))
           bgcolor = self.recv_relay(self.bytesperpixel)
-          if self.debug:
-            print(' RREEncoding: subrects=%d, bgcolor=%r' % (nsubrects, bgcolor), file=stderr)
           if self.fb:
             self.fb.process_solid(x0, y0, width, height, bgcolor)
           for i in range(nsubrects):
-            fgcolor = self.recv_relay(self.bytesperpixel)
-            (x,y,w,h) = unpack('>HHHH', self.recv_relay(8))
+            # read the color and the rect at once: a view is only valid until the next recv.
+            data = self.recv_relay(self.bytesperpixel+8)
+            fgcolor = data[:self.bytesperpixel]
+            (x,y,w,h) = unpack('>HHHH', data[self.bytesperpixel:])
             if self.fb:
               self.fb.process_solid(x0+x, y0+y, w, h, fgcolor)
-            if 2 <= self.debug:
-              print(' RREEncoding: ', (x,y,w,h,fgcolor), file=stderr)
         # CoRREEncoding
         elif t == 4:
           (nsubrects,) = unpack('>L', self.recv_relay(4))
           bgcolor = self.recv_relay(self.bytesperpixel)
-          if self.debug:
-            print(' CoRREEncoding: subrects=%d, bgcolor=%r' % (nsubrects, bgcolor), file=stderr)
           if self.fb:
             self.fb.process_solid(x0, y0, width, height, bgcolor)
           for i in range(nsubrects):
-            fgcolor = self.recv_relay(self.bytesperpixel)
-            (x,y,w,h) = unpack('>BBBB', self.recv_relay(4))
+            data = self.recv_relay(self.bytesperpixel+4)
+            fgcolor = data[:self.bytesperpixel]
+            (x,y,w,h) = unpack('>BBBB', data[self.bytesperpixel:])
             if self.fb:
               self.fb.process_solid(x0+x, y0+y, w, h, fgcolor)
-            if 2 <= self.debug:
-              print(' CoRREEncoding: ', (x,y,w,h,fgcolor), file=stderr)
         # HextileEncoding
         elif t == 5:
-          if self.debug:
-            print(' HextileEncoding', file=stderr)
-          (fgcolor, bgcolor) = (None, None)
-          for y in range(0, height, 16):
-            for x in range(0, width, 16):
-              w = min(width-x, 16)
-              h = min(height-y, 16)
-              c = ord(self.recv_relay(1))
-              assert c < 32
-              # Raw
-              if c & 1:
-                l = w*h*self.bytesperpixel
-                data = self.recv_relay(l)
-                if self.fb:
-                  self.fb.process_pixels(x0+x, y0+y, w, h, data)
-                if 2 <= self.debug:
-                  print('  Raw:', l, file=stderr)
-                continue
-              if c & 2:
-                bgcolor = self.recv_relay(self.bytesperpixel)
-              if c & 4:
-                fgcolor = self.recv_relay(self.bytesperpixel)
-              if self.fb:
-                self.fb.process_solid(x0+x, y0+y, w, h, bgcolor)
-              # Solid
-              if not c & 8:
-                if 2 <= self.debug:
-                  print('  Solid:', repr(bgcolor), file=stderr)
-                continue
-              nsubrects = ord(self.recv_relay(1))
-              # SubrectsColoured
-              if c & 16:
-                if 2 <= self.debug:
-                  print('  SubrectsColoured:', nsubrects, repr(bgcolor), file=stderr)
-                for i in range(nsubrects):
-                  color = self.recv_relay(self.bytesperpixel)
-                  (xy,wh) = unpack('>BB', self.recv_relay(2))
-                  if self.fb:
-                    self.fb.process_solid(x0+x+(xy>>4), y0+y+(xy&15), (wh>>4)+1, (wh&15)+1, color)
-                  if 3 <= self.debug:
-                    print('   ', repr(color), (xy,wh), file=stderr)
-              # NoSubrectsColoured
-              else:
-                if 2 <= self.debug:
-                  print('  NoSubrectsColoured:', nsubrects, repr(bgcolor), file=stderr)
-                for i in range(nsubrects):
-                  (xy,wh) = unpack('>BB', self.recv_relay(2))
-                  if self.fb:
-                    self.fb.process_solid(x0+x+(xy>>4), y0+y+(xy&15), (wh>>4)+1, (wh&15)+1, fgcolor)
-                  if 3 <= self.debug:
-                    print('  ', (xy,wh), file=stderr)
+          nsubrects = self.process_hextile(x0, y0, width, height)
+        # ZlibEncoding
+        elif t == 6:
+          (length,) = unpack('>L', self.recv_relay(4))
+          data = self.recv_relay(length)
+          # the zlib stream must be fed even if the data is not used.
+          data = self.zlib_stream.decompress(data)
+          if self.fb:
+            self.fb.process_pixels(x0, y0, width, height, data)
+        # ZlibHexEncoding
+        elif t == 8:
+          nsubrects = self.process_hextile(x0, y0, width, height, zlibhex=True)
+        # TightEncoding
+        elif t == 7:
+          self.process_tight(x0, y0, width, height)
         # ZRLEEncoding
         elif t == 16:
-          raise RFBProtocolError('unsupported: ZRLEEncoding')
+          (length,) = unpack('>L', self.recv_relay(4))
+          data = self.recv_relay(length)
+          # the zlib stream must be fed even if the data is not used.
+          data = self.zrle_stream.decompress(data)
+          if self.fb:
+            self.process_zrle(x0, y0, width, height, data)
         # RichCursor
         elif t == -239:
           if width and height:
             rowbytes = (width + 7) // 8;
-            # Cursor image RGB
-            data = self.recv_relay(width * height * self.bytesperpixel)
-            # Cursor mask -> 1 bit/pixel (1 -> image; 0 -> transparent)
-            mask = self.recv_relay(rowbytes * height)
-            # Set the alpha channel with maskData where bit=1 -> alpha = 255, bit=0 -> alpha=255
-            if self.debug:
-              print('RichCursor: %dx%d at %d,%d' % (width,height,x0,y0), file=stderr)
+            # Cursor image (pixels) and mask -> 1 bit/pixel (1 -> image; 0 -> transparent)
+            n = width * height * self.bytesperpixel
+            data = bytes(self.recv_relay(n + rowbytes * height))
             if self.fb:
-              data = self.fb.convert_pixels(data)
-              mask = ''.join([ byte2bit(mask[p:p+rowbytes])[:width]
-                               for p in range(0, height*rowbytes, rowbytes) ])
-              def conv1(i):
-                if mask[i//4] == b'\x01':
-                  return b'\xff'+data[i]+data[i+1]+data[i+2]
-                else:
-                  return b'\x00\x00\x00\x00'
-              data = ''.join([ conv1(i) for i in range(0, len(data), 4) ])
-              self.fb.change_cursor(width, height, x0, y0, data)
+              key = (t, width, height, data)
+              if key not in self.cursor_cache:
+                pixels = self.fb.convert_pixels(data[:n])
+                # RGB or RGBX
+                stride = len(pixels) // (width * height)
+                self.cache_cursor(key, cursor_image(width, height,
+                                                    [ pixels[c::stride] for c in range(3) ],
+                                                    data[n:]))
+              self.fb.change_cursor(width, height, x0, y0, self.cursor_cache[key])
         # XCursor
         elif t == -240:
           if width and height:
             rowbytes = (width + 7) // 8;
-            # Foreground RGB
-            fgcolor = self.recv_relay(3)
-            # Background RGB
-            bgcolor = self.recv_relay(3)
-            # Cursor Data -> 1 bit/pixel
-            data = self.recv_relay(rowbytes * height)
-            # Cursor Mask -> 1 bit/pixel
-            mask = self.recv_relay(rowbytes * height)
-            # Create the image from cursordata and maskdata.
-            if self.debug:
-              print('XCursor: %dx%d at %d,%d' % (width,height,x0,y0), file=stderr)
+            # Foreground RGB, Background RGB,
+            # Cursor Data -> 1 bit/pixel and Cursor Mask -> 1 bit/pixel
+            data = bytes(self.recv_relay(6 + rowbytes * height * 2))
             if self.fb:
-              data = ''.join([ byte2bit(data[p:p+rowbytes])[:width]
-                               for p in range(0, height*rowbytes, rowbytes) ])
-              mask = ''.join([ byte2bit(mask[p:p+rowbytes])[:width]
-                               for p in range(0, height*rowbytes, rowbytes) ])
-              def conv1(i):
-                if mask[i] == b'\x01':
-                  if data[i] == b'\x01':
-                    return b'\xff'+fgcolor
-                  else:
-                    return b'\xff'+bgcolor
-                else:
-                  return b'\x00\x00\x00\x00'
-              data = ''.join([ conv1(i) for i in range(len(data)) ])
-              self.fb.change_cursor(width, height, x0, y0, data)
+              key = (t, width, height, data)
+              if key not in self.cursor_cache:
+                (fgcolor, bgcolor) = (data[0:3], data[3:6])
+                bits = unpack_indices(data[6:6+rowbytes*height], 1, width, height)
+                colors = [ bits.translate(bytes([bgcolor[c], fgcolor[c]]).ljust(256, b'\x00'))
+                           for c in range(3) ]
+                self.cache_cursor(key, cursor_image(width, height, colors,
+                                                    data[6+rowbytes*height:]))
+              self.fb.change_cursor(width, height, x0, y0, self.cursor_cache[key])
         # CursorPos -> only change the cursor position
         elif t == -232:
-          if self.debug:
-            print('CursorPos: %d,%d' % (x0,y0), file=stderr)
           if self.fb:
             self.fb.move_cursor(x0, y0)
         else:
           raise RFBProtocolError('Illegal encoding: 0x%02x' % t)
+        if stats:
+          stats.add_rect(t, self.received-pos, nsubrects, time.perf_counter()-t0)
+      if not self.continuous:
+        self.update_pending = False
       self.finish_update()
+      if stats:
+        stats.update_done()
+      if lost:
+        # requested after the update, as the one outstanding request.
+        self.request_refresh(*bounding_rect(lost))
+        self.update_pending = True
+        if stats:
+          stats.request_sent()
+      if self.tuner and self.tuner.probing:
+        self.tuner.probe_done(self.received, time.thread_time()-cpu)
+        if not self.tuner.probing:
+          encoding = self.tuner.encoding
+          print('Encoding: %s (%r)' % (ENCODING_NAMES.get(encoding, encoding), self.tuner),
+                file=stderr)
+          self.send_encodings()
+      if self.throttle is not None and self.fb:
+        # server changes until then are coalesced into the next update.
+        self.next_request = self.fb.next_frame_time(time.time() + self.throttle) - self.throttle
     elif c == b'\x01':
-      (first, ncolours) = unpack('>xHH', self.recv_relay(11))
+      (first, ncolours) = unpack('>xHH', self.recv_relay(5))
       if self.debug:
         print('SetColourMapEntries: first=%d, ncolours=%d' % (first, ncolours), file=stderr)
-      for i in ncolours:
-        self.recv_relay(6)
+      # each colour is given as 16-bit RGB.
+      data = bytes(self.recv_relay(ncolours*6))
+      if self.fb:
+        self.fb.change_colourmap()
+      for (c, table) in enumerate(self.colourmap):
+        table[first:first+ncolours] = data[c*2::6]
+        del table[256:]
 
     elif c == b'\x02':
       if self.debug:
@@ -462,11 +960,306 @@ class RFBProxy:
       if self.debug:
         print('ServerCutText: %r' % data, file=stderr)
 
+    elif c == b'\x96':
+      # EndOfContinuousUpdates: the server supports ContinuousUpdates
+      # (or it confirms that they are now disabled).
+      if self.debug:
+        print('EndOfContinuousUpdates', file=stderr)
+      if self.continuous:
+        self.continuous = False
+        self.update_pending = False
+      else:
+        self.start_continuous_updates()
+
     else:
-      raise RFBProtocolError('Unsupported msg: %d' % ord(c))
+      raise RFBProtocolError('Unsupported msg: %d' % c[0])
 
     return True
 
+  def process_hextile(self, x0, y0, width, height, zlibhex=False):
+    # The tiles are assembled into one buffer and passed to
+    # the frame buffer at once.
+    bpp = self.bytesperpixel
+    rowbytes = width*bpp
+    if self.fb:
+      buf = bytearray(rowbytes*height)
+    def fill(x, y, w, h, color):
+      line = color*w
+      i = (y*width+x)*bpp
+      for i in range(i, i+h*rowbytes, rowbytes):
+        buf[i:i+len(line)] = line
+      return
+    def paste(x, y, w, h, data):
+      n = w*bpp
+      i = (y*width+x)*bpp
+      for j in range(0, n*h, n):
+        buf[i:i+n] = data[j:j+n]
+        i += rowbytes
+      return
+    (fgcolor, bgcolor) = (None, None)
+    nsubrects = 0
+    for y in range(0, height, 16):
+      for x in range(0, width, 16):
+        w = min(width-x, 16)
+        h = min(height-y, 16)
+        c = self.recv_relay(1)[0]
+        recv = self.recv_relay
+        if zlibhex:
+          # ZlibRaw: compressed raw pixels.
+          if c & 32:
+            (length,) = unpack('>H', self.recv_relay(2))
+            data = self.zlibhex_streams[0].decompress(self.recv_relay(length))
+            if self.fb:
+              paste(x, y, w, h, data)
+            if 2 <= self.debug:
+              print('  ZlibRaw:', length, file=stderr)
+            continue
+          # Zlib: the rest of the tile is compressed.
+          if c & 64:
+            (length,) = unpack('>H', self.recv_relay(2))
+            recv = BytesIO(self.zlibhex_streams[1].decompress(self.recv_relay(length))).read
+            if 2 <= self.debug:
+              print('  Zlib:', length, file=stderr)
+            c &= 31
+        assert c < 32
+        # Raw
+        if c & 1:
+          l = w*h*bpp
+          data = recv(l)
+          if self.fb:
+            paste(x, y, w, h, data)
+          if 2 <= self.debug:
+            print('  Raw:', l, file=stderr)
+          continue
+        # the colors are kept across tiles, so they must be copied.
+        if c & 2:
+          bgcolor = bytes(recv(bpp))
+        if c & 4:
+          fgcolor = bytes(recv(bpp))
+        if self.fb:
+          fill(x, y, w, h, bgcolor)
+        # Solid
+        if not c & 8:
+          if 2 <= self.debug:
+            print('  Solid:', repr(bgcolor), file=stderr)
+          continue
+        n = recv(1)[0]
+        nsubrects += n
+        # SubrectsColoured
+        if c & 16:
+          if 2 <= self.debug:
+            print('  SubrectsColoured:', n, repr(bgcolor), file=stderr)
+          data = recv(n*(bpp+2))
+          if self.fb:
+            for (color,xy,wh) in iter_unpack('%dsBB' % bpp, data):
+              fill(x+(xy>>4), y+(xy&15), (wh>>4)+1, (wh&15)+1, color)
+          if 3 <= self.debug:
+            for (color,xy,wh) in iter_unpack('%dsBB' % bpp, data):
+              print('   ', repr(color), (xy,wh), file=stderr)
+        # NoSubrectsColoured
+        else:
+          if 2 <= self.debug:
+            print('  NoSubrectsColoured:', n, repr(bgcolor), file=stderr)
+          data = recv(n*2)
+          if self.fb:
+            for (xy,wh) in iter_unpack('BB', data):
+              fill(x+(xy>>4), y+(xy&15), (wh>>4)+1, (wh&15)+1, fgcolor)
+          if 3 <= self.debug:
+            for (xy,wh) in iter_unpack('BB', data):
+              print('  ', (xy,wh), file=stderr)
+    if self.fb:
+      self.fb.process_pixels(x0, y0, width, height, buf)
+    return nsubrects
+
+  def process_zrle(self, x0, y0, width, height, data):
+    (csize, offset) = self.cpixel
+    bpp = self.bytesperpixel
+    if csize == bpp:
+      expand = bytes
+    else:
+      def expand(c):
+        return expand_cpixels(c, offset)
+    def read_palette(i, n):
+      return [ bytes(expand(data[j:j+csize])) for j in range(i, i+n*csize, csize) ]
+    i = 0
+    for y in range(0, height, 64):
+      h = min(height-y, 64)
+      for x in range(0, width, 64):
+        w = min(width-x, 64)
+        subenc = data[i]
+        i += 1
+        # Raw
+        if subenc == 0:
+          n = w*h*csize
+          self.fb.process_pixels(x0+x, y0+y, w, h, expand(data[i:i+n]))
+          i += n
+        # Solid
+        elif subenc == 1:
+          self.fb.process_solid(x0+x, y0+y, w, h, expand(data[i:i+csize]))
+          i += csize
+        # Packed palette
+        elif subenc <= 16:
+          palette = read_palette(i, subenc)
+          i += subenc*csize
+          if subenc == 2:
+            bits = 1
+          elif subenc <= 4:
+            bits = 2
+          else:
+            bits = 4
+          n = (w*bits+7)//8*h
+          indices = unpack_indices(data[i:i+n], bits, w, h)
+          i += n
+          self.fb.process_pixels(x0+x, y0+y, w, h, lookup_pixels(indices, palette, bpp))
+        # Plain RLE / Palette RLE
+        elif subenc == 128 or 130 <= subenc:
+          if subenc == 128:
+            palette = None
+          else:
+            palette = read_palette(i, subenc-128)
+            i += (subenc-128)*csize
+          runs = []
+          left = w*h
+          while 0 < left:
+            if palette is None:
+              c = bytes(expand(data[i:i+csize]))
+              i += csize
+              n = 1
+              rle = True
+            else:
+              c = data[i]
+              i += 1
+              rle = c & 128
+              c = palette[c & 127]
+              n = 1
+            if rle:
+              while 1:
+                b = data[i]
+                i += 1
+                n += b
+                if b != 255: break
+            runs.append(c*n)
+            left -= n
+          self.fb.process_pixels(x0+x, y0+y, w, h, b''.join(runs))
+        else:
+          raise RFBProtocolError('Illegal ZRLE subencoding: %d' % subenc)
+    return
+
+  def recv_compact_length(self):
+    b = self.recv_relay(1)[0]
+    n = b & 127
+    if b & 128:
+      b = self.recv_relay(1)[0]
+      n |= (b & 127) << 7
+      if b & 128:
+        b = self.recv_relay(1)[0]
+        n |= b << 14
+    return n
+
+  def tight_pixel(self, rgb):
+    # converts a 3-byte TPIXEL into a full pixel.
+    (bitsperpixel, depth, bigendian, truecolour,
+     red_max, green_max, blue_max,
+     red_shift, green_shift, blue_shift) = self.pixelformat
+    v = (rgb[0] << red_shift) | (rgb[1] << green_shift) | (rgb[2] << blue_shift)
+    if bigendian:
+      return pack('>L', v)
+    else:
+      return pack('<L', v)
+
+  def tight_components(self, data, decompose):
+    # splits the Tight pixels into (r,g,b) components, or joins them.
+    if self.tpixel == 3:
+      if decompose:
+        return data
+      return bytes(data)
+    (bitsperpixel, depth, bigendian, truecolour,
+     red_max, green_max, blue_max,
+     red_shift, green_shift, blue_shift) = self.pixelformat
+    fmt = ('<', '>')[bool(bigendian)] + '%d' + {1:'B', 2:'H', 4:'L'}[self.tpixel]
+    if decompose:
+      values = unpack(fmt % (len(data)//self.tpixel), data)
+      return [ (v >> s) & m for v in values
+               for (s,m) in ((red_shift,red_max), (green_shift,green_max), (blue_shift,blue_max)) ]
+    values = [ (r << red_shift) | (g << green_shift) | (b << blue_shift)
+               for (r,g,b) in zip(data[0::3], data[1::3], data[2::3]) ]
+    return pack(fmt % len(values), *values)
+
+  def process_tight(self, x0, y0, width, height):
+    tsize = self.tpixel
+    comp = self.recv_relay(1)[0]
+    for i in range(4):
+      if comp & (1<<i):
+        self.tight_streams[i] = zlib.decompressobj()
+    comp >>= 4
+    # FillCompression
+    if comp == 8:
+      color = self.recv_relay(tsize)
+      if self.debug:
+        print(' TightEncoding: fill', file=stderr)
+      if self.fb:
+        if tsize == 3:
+          color = self.tight_pixel(color)
+        self.fb.process_solid(x0, y0, width, height, color)
+      return
+    # JpegCompression
+    if comp == 9:
+      length = self.recv_compact_length()
+      data = self.recv_relay(length)
+      if self.debug:
+        print(' TightEncoding: jpeg, len=%d' % length, file=stderr)
+      if self.fb:
+        img = create_image_from_jpeg(bytes(data))
+        if imgsize(img) != (width, height):
+          raise RFBProtocolError('Illegal JPEG size: %r' % (imgsize(img),))
+        self.fb.process_rgb(x0, y0, width, height, convert_image_to_string_rgb(img))
+      return
+    if 9 < comp:
+      raise RFBProtocolError('Illegal Tight compression: 0x%02x' % comp)
+    # BasicCompression
+    stream = self.tight_streams[comp & 3]
+    filter_id = 0
+    if comp & 4:
+      filter_id = self.recv_relay(1)[0]
+    if filter_id == 0 or filter_id == 2:
+      # CopyFilter / GradientFilter
+      size = width*height*tsize
+    elif filter_id == 1:
+      # PaletteFilter
+      ncolors = self.recv_relay(1)[0]+1
+      data = self.recv_relay(ncolors*tsize)
+      palette = [ bytes(data[i:i+tsize]) for i in range(0, ncolors*tsize, tsize) ]
+      if ncolors == 2:
+        size = (width+7)//8*height
+      else:
+        size = width*height
+    else:
+      raise RFBProtocolError('Illegal Tight filter: %d' % filter_id)
+    if size < 12:
+      data = bytes(self.recv_relay(size))
+    else:
+      length = self.recv_compact_length()
+      data = stream.decompress(self.recv_relay(length))
+    if self.debug:
+      print(' TightEncoding: stream=%d, filter=%d, len=%d' % (comp & 3, filter_id, size), file=stderr)
+    if not self.fb:
+      return
+    if filter_id == 1:
+      if ncolors == 2:
+        indices = unpack_indices(data, 1, width, height)
+      else:
+        indices = data
+      data = lookup_pixels(indices, palette, tsize)
+    elif filter_id == 2:
+      data = tight_gradient(self.tight_components(data, True), width, height,
+                            self.pixelformat[4:7])
+      data = self.tight_components(data, False)
+    if tsize == 3:
+      self.fb.process_rgb(x0, y0, width, height, data)
+    else:
+      self.fb.process_pixels(x0, y0, width, height, data)
+    return
+
   # JRH - castro - begin
   def set_loop(self):
     mb.recording_should_continue.write(True)
@@ -476,6 +1269,9 @@ class RFBProxy:
     self.do_another_loop = mb.recording_should_continue.read()
     return self.do_another_loop
 
+  # how often (in seconds) the messageboard is checked while recording.
+  STOP_CHECK_INTERVAL = 0.5
+
   #def loop(self):
   #  while self.loop1():
   #    pass
@@ -484,9 +1280,13 @@ class RFBProxy:
 
   def loop(self):
     self.set_loop()
-    while self.do_another_loop == True:
+    t0 = time.time()
+    while self.do_another_loop == True and not self.interrupted:
       if not self.loop1(): break
-      self.get_loop()
+      t = time.time()
+      if self.STOP_CHECK_INTERVAL <= t-t0:
+        self.get_loop()
+        t0 = t
     self.finish_update()
     return self
   # JRH - castro - end
@@ -497,62 +1297,202 @@ class RFBProxy:
     return
 
 
+##  RFBNetworkMixin
+##
+##  The client messages of RFBNetworkClient and AsyncRFBClient.
+##  A client provides send(), host, port and continuous_updates.
+##
+class RFBNetworkMixin:
+
+  def getpass(self):
+    import getpass
+    return getpass.getpass('Password for %s:%d: ' % (self.host, self.port))
+
+  def get_encodings(self):
+    encodings = RFBProxy.get_encodings(self)
+    if self.continuous_updates and self.throttle is None and not (self.tuner and self.tuner.probing):
+      # ContinuousUpdates pseudo encoding
+      encodings += (-313,)
+    return encodings
+
+  def request_update(self, incremental=True):
+    if self.debug:
+      print('FrameBufferUpdateRequest', file=stderr)
+    self.send(pack('>BBHHHH', 3, incremental, *self.clipping))
+    return
+
+  def request_refresh(self, x, y, width, height):
+    if self.debug:
+      print('FrameBufferUpdateRequest (refresh): %dx%d at (%d,%d)' % (width, height, x, y), file=stderr)
+    self.send(b'\x03\x00' + pack('>HHHH', x, y, width, height))
+    return
+
+  def start_continuous_updates(self):
+    if self.debug:
+      print('EnableContinuousUpdates', file=stderr)
+    self.send(b'\x96\x01' + pack('>HHHH', *self.clipping))
+    self.continuous = True
+    self.update_pending = True
+    return
+
+
 ##  RFBNetworkClient
 ##
-class RFBNetworkClient(RFBProxy):
+class RFBNetworkClient(RFBNetworkMixin, RFBProxy):
+
+  """
+  RFBNetworkClient reads the server messages through a reusable
+  receive buffer. recv() returns memoryviews into this buffer, so
+  small reads (Hextile tiles, subrects) do not cost a syscall each.
+
+  The client waits for the server with a selector, so an idle
+  desktop costs (almost) nothing. wakeup() can be called from another
+  thread to make a waiting loop1() return immediately.
+
+  bufsize: size of the receive buffer.
+  rcvbuf: SO_RCVBUF of the socket (None: system default).
+  nodelay: sets TCP_NODELAY.
+  idle_timeout: the longest time loop1() blocks when nothing happens.
+  continuous_updates: uses ContinuousUpdates if the server supports it.
+  pixel_format: name of the pixel format requested (see PIXEL_FORMATS).
+  throttle: requests updates only as often as the output frames
+    (this many seconds before each frame), instead of all the time.
+    ContinuousUpdates are not used then.
+  """
   
   def __init__(self, host, port, fb=None, pwdfile=None,
-               preferred_encoding=(0,5), debug=0):
+               preferred_encoding=(0,5), debug=0,
+               bufsize=262144, rcvbuf=None, nodelay=True,
+               idle_timeout=0.5, continuous_updates=True, pixel_format=None,
+               throttle=None, stats=None, tuner=None):
     RFBProxy.__init__(self, fb=fb, pwdfile=pwdfile,
-                      preferred_encoding=preferred_encoding, debug=debug)
+                      preferred_encoding=preferred_encoding, debug=debug,
+                      pixel_format=pixel_format, throttle=throttle, stats=stats,
+                      tuner=tuner)
     self.host = host
     self.port = port
+    self.bufsize = bufsize
+    self.rcvbuf = rcvbuf
+    self.nodelay = nodelay
+    self.idle_timeout = idle_timeout
+    self.continuous_updates = continuous_updates
+    (self.sock, self.selector) = (None, None)
+    (self.wakeup_r, self.wakeup_w) = socket.socketpair()
+    self.wakeup_r.setblocking(False)
+    self.wakeup_w.setblocking(False)
     return
 
   def init(self):
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # SO_RCVBUF must be set before connect() to take effect on the window.
+    if self.rcvbuf:
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+    if self.nodelay:
+      self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     self.sock.connect((self.host, self.port))
+    self.buf = bytearray(self.bufsize)
+    self.bufview = memoryview(self.buf)
+    (self.bufpos, self.buflen) = (0, 0)
+    self.selector = selectors.DefaultSelector()
+    self.selector.register(self.sock, selectors.EVENT_READ)
+    self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+    self.interrupted = False
     x = RFBProxy.init(self)
     print('Connected: %s:%d, protocol_version=3.%d, preferred_encoding=%s' % \
           (self.host, self.port, self.protocol_version, self.preferred_encoding), file=stderr)
     return x
 
   def recv(self, n):
-    # MS-Windows doesn't have MSG_WAITALL, so we emulate it.
-    buf = b''
-    n0 = n
-    while n:
-      x = self.sock.recv(n)
+    # The returned view is only valid until the next recv() call,
+    # because the buffer is reused (and compacted) afterwards.
+    self.received += n
+    pos = self.bufpos
+    if self.buflen - pos < n:
+      if self.bufsize < n:
+        return self.recv_large(n)
+      self.fill(n)
+      pos = self.bufpos
+    self.bufpos = pos+n
+    return self.bufview[pos:pos+n]
+
+  def fill(self, n):
+    # Make sure that at least n bytes are in the buffer.
+    # MS-Windows doesn't have MSG_WAITALL, so we loop ourselves.
+    if self.bufsize < self.bufpos+n:
+      # not enough room at the end: move the unread part to the front.
+      rest = self.buflen - self.bufpos
+      self.buf[:rest] = bytes(self.bufview[self.bufpos:self.buflen])
+      (self.bufpos, self.buflen) = (0, rest)
+    while self.buflen - self.bufpos < n:
+      x = self.sock.recv_into(self.bufview[self.buflen:])
+      if not x: raise RFBProtocolError('Connection closed unexpectedly.')
+      self.buflen += x
+    return
+
+  def recv_large(self, n):
+    # A chunk larger than the buffer (e.g. a big Raw rectangle) is
+    # received directly into its own bytearray.
+    data = bytearray(n)
+    view = memoryview(data)
+    rest = self.buflen - self.bufpos
+    view[:rest] = self.bufview[self.bufpos:self.buflen]
+    (self.bufpos, self.buflen) = (0, 0)
+    while rest < n:
+      x = self.sock.recv_into(view[rest:])
       if not x: raise RFBProtocolError('Connection closed unexpectedly.')
-      buf += x
-      n -= len(x)
-    return buf
+      rest += x
+    return view
 
   def recv_byte_with_timeout(self):
-    self.sock.settimeout(0.05)
+    if self.bufpos == self.buflen and not self.wait(self.idle_timeout):
+      return None
+    return self.recv_relay(1)
+
+  def pause(self, timeout):
+    return self.bufpos < self.buflen or self.wait(lowerbound(0, min(timeout, self.idle_timeout)))
+
+  def wait(self, timeout):
+    "Blocks until the server sends something (True), or a timeout/wakeup (False)."
+    readable = False
+    for (key, _) in self.selector.select(timeout):
+      if key.fileobj is self.sock:
+        readable = True
+      else:
+        try:
+          self.wakeup_r.recv(64)
+        except BlockingIOError:
+          pass
+    return readable
+
+  def wakeup(self):
+    "Wakes up a waiting loop1(). Can be called from any thread."
     try:
-      c = self.recv_relay(1)
-    except socket.timeout:
-      c = None
-    self.sock.settimeout(None)
-    return c
+      self.wakeup_w.send(b'\x00')
+    except BlockingIOError:
+      pass
+    return
+
+  def interrupt(self):
+    "Stops loop() as soon as possible. Can be called from any thread."
+    self.interrupted = True
+    self.wakeup()
+    return
 
   def send(self, s):
-    return self.sock.send(s)
+    return self.sock.sendall(s)
     
-  def getpass(self):
-    import getpass
-    return getpass.getpass('Password for %s:%d: ' % (self.host, self.port))
-
-  def request_update(self):
-    if self.debug:
-      print('FrameBufferUpdateRequest', file=stderr)
-    self.send(b'\x03\x01' + pack('>HHHH', *self.clipping))
+  def disconnect(self):
+    "Closes the connection only. init() can be called again to reconnect."
+    if self.selector:
+      self.selector.close()
+    if self.sock:
+      self.sock.close()
+    (self.sock, self.selector) = (None, None)
     return
 
   def close(self):
     RFBProxy.close(self)
-    self.sock.close()
+    self.disconnect()
     return
 
 
@@ -561,32 +1501,58 @@ class RFBNetworkClient(RFBProxy):
 class RFBNetworkClientForRecording(RFBNetworkClient):
   
   def __init__(self, host, port, fp, pwdfile=None,
-               preferred_encoding=(5,0), debug=0):
+               preferred_encoding=(5,0), debug=0, pixel_format=None, stats=None,
+               index=None):
+    # every update must be requested (and timestamped) by us,
+    # so ContinuousUpdates cannot be used here.
     RFBNetworkClient.__init__(self, host, port, fb=None, pwdfile=pwdfile,
-                              preferred_encoding=preferred_encoding, debug=debug)
+                              preferred_encoding=preferred_encoding, debug=debug,
+                              continuous_updates=False, pixel_format=pixel_format,
+                              stats=stats)
     print('Creating vncrec: %r: vncLog0.0' % fp, file=stderr)
     self.fp = fp
-    self.write('vncLog0.0')
+    # index: VncRecIndexWriter or None.
+    self.index = index
+    self.written = 0
+    # the offset of the last index record.
+    self.indexed = 0
+    self.curtime = 0
+    self.write(b'vncLog0.0')
     # disguise data (security=none)
-    self.write('RFB 003.003\x0a')
+    self.write(b'RFB 003.003\x0a')
     self.write(b'\x00\x00\x00\x01')
-    self.updated = True
     return
 
   def write(self, x):
     self.fp.write(x)
+    self.written += len(x)
     return
 
-  def request_update(self):
-    if self.updated:
-      self.updated = False
-      t = time.time()
-      self.write(pack('>LL', int(t), int((t-int(t))*1000000)))
-      RFBNetworkClient.request_update(self)
+  def request_update(self, incremental=True):
+    # called only when no request is outstanding.
+    t = time.time()
+    (sec, usec) = (int(t), int((t-int(t))*1000000))
+    self.write(pack('>LL', sec, usec))
+    # the same time as RFBFileParser reads.
+    self.curtime = sec+usec/1000000
+    RFBNetworkClient.request_update(self, incremental)
     return
   
   def finish_update(self):
-    self.updated = True
+    # loop() calls this once more at the end.
+    if self.written == self.indexed: return
+    self.indexed = self.written
+    if self.index:
+      self.index.add(self.curtime, self.written)
+    # compressed chunks end at update boundaries.
+    if isinstance(self.fp, VncRecZWriter):
+      self.fp.end_update()
+    return
+
+  def close(self):
+    RFBNetworkClient.close(self)
+    if self.index:
+      self.index.close()
     return
   
   def recv_relay(self, n):
@@ -595,6 +1561,166 @@ class RFBNetworkClientForRecording(RFBNetworkClient):
     return data
 
 
+##  AsyncRFBClient
+##
+class AsyncRFBClient(RFBNetworkMixin, RFBProxy):
+
+  """
+  AsyncRFBClient is an RFB client driven by an asyncio event loop,
+  so that one process can record many displays at a time.
+
+  The socket is read and written by the event loop (asyncio streams).
+  The protocol handling (RFBProxy.init/auth/start/loop1) and the frame
+  buffer, which does the encoding, run in a thread pool. The pool can be
+  shared by many clients and bounds the number of threads used. A client
+  occupies a thread only while a server message is being processed.
+  stop() also ends a read in the middle of a message.
+
+  executor: concurrent.futures.Executor to run the protocol handling
+    (None: the default executor of the event loop).
+  """
+
+  def __init__(self, host, port, fb=None, pwdfile=None,
+               preferred_encoding=(0,5), debug=0,
+               executor=None, nodelay=True, continuous_updates=True,
+               pixel_format=None, throttle=None, stats=None, tuner=None):
+    RFBProxy.__init__(self, fb=fb, pwdfile=pwdfile,
+                      preferred_encoding=preferred_encoding, debug=debug,
+                      pixel_format=pixel_format, throttle=throttle, stats=stats,
+                      tuner=tuner)
+    self.host = host
+    self.port = port
+    self.executor = executor
+    self.nodelay = nodelay
+    self.continuous_updates = continuous_updates
+    self.loop = None
+    self.stopped = asyncio.Event()
+    return
+
+  async def call(self, func):
+    return await self.loop.run_in_executor(self.executor, func)
+
+  async def run(self):
+    "Connects to the server and records until stop() is called."
+    self.loop = asyncio.get_running_loop()
+    (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+    if self.nodelay:
+      sock = self.writer.get_extra_info('socket')
+      if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    (self.buf, self.bufpos) = (bytearray(), 0)
+    try:
+      await self.call(lambda: self.init().auth().start())
+      print('Connected: %s:%d, protocol_version=3.%d, preferred_encoding=%s' % \
+            (self.host, self.port, self.protocol_version, self.preferred_encoding), file=stderr)
+      self.set_loop()
+      t0 = time.time()
+      while self.do_another_loop == True and not self.interrupted:
+        try:
+          if not await self.call(self.loop1): break
+        except RFBInterrupted:
+          break
+        # wait on the event loop (not in the pool) for the next message.
+        if self.bufpos == len(self.buf):
+          if self.update_pending:
+            if not await self.wait(self.STOP_CHECK_INTERVAL): break
+          else:
+            # throttled: wait for the next output frame.
+            delay = min(self.next_request - time.time(), self.STOP_CHECK_INTERVAL)
+            if 0 < delay and not await self.wait(delay): break
+        t = time.time()
+        if self.STOP_CHECK_INTERVAL <= t-t0:
+          self.get_loop()
+          t0 = t
+      await self.call(self.finish_update)
+    except RFBInterrupted:
+      # stopped while connecting.
+      pass
+    finally:
+      await self.call(self.close)
+    return self
+
+  async def read(self, size, timeout=None):
+    "Reads at most size bytes (b'' at EOF). Returns None after stop() or a timeout."
+    read = asyncio.ensure_future(self.reader.read(size))
+    stop = asyncio.ensure_future(self.stopped.wait())
+    await asyncio.wait((read, stop), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    stop.cancel()
+    if not read.done():
+      read.cancel()
+      return None
+    return read.result()
+
+  async def wait(self, timeout):
+    "Waits until the server sends something, stop() or a timeout (True), or EOF (False)."
+    data = await self.read(65536, timeout)
+    if data is None:
+      return True
+    self.buf += data
+    return bool(data)
+
+  def stop(self):
+    "Stops the recording as soon as possible. Can be called from any thread."
+    self.interrupted = True
+    if self.loop:
+      self.loop.call_soon_threadsafe(self.stopped.set)
+    return
+
+  # The following methods are called in the pool.
+
+  def recv(self, n):
+    self.received += n
+    while len(self.buf) - self.bufpos < n:
+      if self.bufpos:
+        del self.buf[:self.bufpos]
+        self.bufpos = 0
+      size = lowerbound(n-len(self.buf), 65536)
+      data = asyncio.run_coroutine_threadsafe(self.read(size), self.loop).result()
+      if data is None: raise RFBInterrupted('Stopped.')
+      if not data: raise RFBProtocolError('Connection closed unexpectedly.')
+      self.buf += data
+    pos = self.bufpos
+    self.bufpos = pos+n
+    return bytes(self.buf[pos:pos+n])
+
+  def recv_byte_with_timeout(self):
+    # nothing is waited for here; run() waits on the event loop instead.
+    if self.bufpos == len(self.buf):
+      return None
+    return self.recv_relay(1)
+
+  def pause(self, timeout):
+    return self.bufpos < len(self.buf)
+
+  def send(self, s):
+    self.loop.call_soon_threadsafe(self.writer.write, bytes(s))
+    return
+
+  def close(self):
+    RFBProxy.close(self)
+    self.loop.call_soon_threadsafe(self.writer.close)
+    return
+
+
+##  run_async_clients
+##
+def run_async_clients(clients, max_workers=8):
+  "Runs AsyncRFBClients in one event loop until all of them stop."
+  from concurrent.futures import ThreadPoolExecutor
+  async def main():
+    with ThreadPoolExecutor(max_workers) as executor:
+      for client in clients:
+        if client.executor is None:
+          client.executor = executor
+      results = await asyncio.gather(*[ client.run() for client in clients ],
+                                     return_exceptions=True)
+    for (client, result) in zip(clients, results):
+      if isinstance(result, Exception):
+        print('%s:%d: %s' % (client.host, client.port, result), file=stderr)
+    return results
+  return asyncio.run(main())
+
+
 ##  RFBFileParser
 ##
 class RFBFileParser(RFBProxy):
@@ -604,61 +1730,76 @@ class RFBFileParser(RFBProxy):
     if self.fb:
       self.fb.change_format = False
     self.fp = fp
+    # a regular file is read through mmap (see map_file).
+    self.map = None
+    self.view = None
+    self.pos = 0
     return
 
   def preferred_format(self, bitsperpixel, depth, bigendian, truecolour,
                        red_max, green_max, blue_max,
                        red_shift, green_shift, blue_shift):
-    if (bitsperpixel, depth, bigendian, truecolour,
-        red_max, green_max, blue_max,
-        red_shift, green_shift, blue_shift) == self.FASTEST_FORMAT:
-      return RFBProxy.preferred_format(self, bitsperpixel, depth, bigendian, truecolour,
-                                       red_max, green_max, blue_max,
-                                       red_shift, green_shift, blue_shift)
-    elif self.fb:
-      if bigendian:
-        endian = '>'
-      else:
-        endian = '<'
-      try:
-        length = {8:'B', 16:'H', 32:'L'}[bitsperpixel]
-      except KeyError:
-        raise 'invalid bitsperpixel: %d' % bitsperpixel
-      unpackstr = endian + length
-      nbytes = bitsperpixel // 8
-      bits = {1:1, 3:2, 7:3, 15:4, 31:5, 63:6, 127:7, 255:8}
-      try:
-        e = 'lambda p: (((p>>%d)&%d)<<%d, ((p>>%d)&%d)<<%d, ((p>>%d)&%d)<<%d)' % \
-            (red_shift, red_max, 8-bits[red_max],
-             green_shift, green_max, 8-bits[green_max],
-             blue_shift, blue_max, 8-bits[blue_max])
-      except KeyError:
-        raise 'invalid {red,green,blue}_max: %d, %d or %d' % (red_max, green_max, blue_max)
-      getrgb = eval(e)
-      unpack_pixels = eval('lambda data: unpack("%s%%d%s" %% (len(data)/%d), data)' % (endian, length, nbytes))
-      unpack_color1 = eval('lambda data: unpack("%s", data)' % unpackstr)
-      self.fb.set_converter(lambda data: ''.join([ pack('>BBB', *getrgb(p)) for p in unpack_pixels(data) ]),
-                            lambda data: getrgb(unpack_color1(data)[0]))
+    # the recorded format is used as it is.
+    self.set_converter(bitsperpixel, depth, bigendian, truecolour,
+                       red_max, green_max, blue_max,
+                       red_shift, green_shift, blue_shift)
     return (bitsperpixel, depth, bigendian, truecolour,
             red_max, green_max, blue_max,
             red_shift, green_shift, blue_shift)
 
+  # pos must be at the beginning of an update (i.e. its request).
   def seek(self, pos):
-    self.fp.seek(pos)
+    if self.view is not None:
+      self.pos = pos
+    else:
+      self.fp.seek(pos)
+    self.reset_requests()
     return
   def tell(self):
+    if self.view is not None:
+      return self.pos
     return self.fp.tell()
 
+  # the (uncompressed) size of the recording.
+  def get_size(self):
+    if self.view is not None:
+      return len(self.view)
+    if isinstance(self.fp, VncRecZReader):
+      return self.fp.get_size()
+    return os.fstat(self.fp.fileno()).st_size
+
+  # Maps the file so that recv() is a slice of it.
+  # Pipes and compressed files are read as they are.
+  def map_file(self):
+    try:
+      self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+      return
+    self.view = memoryview(self.map)
+    self.pos = self.fp.tell()
+    return
+
   def init(self):
     self.curtime = 0
     version = self.fp.read(9)
+    if version == ZLOG_MAGIC:
+      self.fp = VncRecZReader(self.fp)
+      version = self.fp.read(9)
+    else:
+      self.map_file()
     print('Reading vncrec file: %s, version=%r...' % (self.fp, version), file=stderr)
-    if version != 'vncLog0.0':
+    if version != b'vncLog0.0':
       raise RFBProtocolError('Unsupported vncrec version: %r' % version)
     return RFBProxy.init(self)
   
   def recv(self, n):
-    x = self.fp.read(n)
+    self.received += n
+    if self.view is not None:
+      pos = self.pos
+      x = self.view[pos:pos+n]
+      self.pos = pos+len(x)
+    else:
+      x = self.fp.read(n)
     if len(x) != n:
       raise EOFError
     return x
@@ -682,7 +1823,7 @@ class RFBFileParser(RFBProxy):
       RFBProxy.auth(self)
     return self
 
-  def request_update(self):
+  def request_update(self, incremental=True):
     (sec, usec) = unpack('>LL', self.recv(8))
     self.curtime = sec+usec/1000000
     return
@@ -702,10 +1843,208 @@ class RFBFileParser(RFBProxy):
 
   def close(self):
     RFBProxy.close(self)
+    if self.view is not None:
+      self.view.release()
+      self.view = None
+      try:
+        self.map.close()
+      except BufferError:
+        # a slice is still in use; the map is closed when it is freed.
+        pass
     self.fp.close()
     return
 
 
+##  Damage tracking
+##
+##  Rectangles are (x, y, width, height) tuples.
+##
+def intersect_rect(r0, r1):
+  (x0,y0,w0,h0) = r0
+  (x1,y1,w1,h1) = r1
+  x = max(x0, x1)
+  y = max(y0, y1)
+  w = min(x0+w0, x1+w1) - x
+  h = min(y0+h0, y1+h1) - y
+  if w <= 0 or h <= 0:
+    return None
+  return (x, y, w, h)
+
+# returns the parts of r0 that are not covered by r1.
+def subtract_rect(r0, r1):
+  r = intersect_rect(r0, r1)
+  if not r:
+    return [r0]
+  (x0,y0,w0,h0) = r0
+  (x,y,w,h) = r
+  rects = []
+  if y0 < y:
+    rects.append((x0, y0, w0, y-y0))
+  if x0 < x:
+    rects.append((x0, y, x-x0, h))
+  if x+w < x0+w0:
+    rects.append((x+w, y, x0+w0-x-w, h))
+  if y+h < y0+h0:
+    rects.append((x0, y+h, w0, y0+h0-y-h))
+  return rects
+
+def bounding_rect(rects):
+  x0 = min( x for (x,y,w,h) in rects )
+  y0 = min( y for (x,y,w,h) in rects )
+  x1 = max( x+w for (x,y,w,h) in rects )
+  y1 = max( y+h for (x,y,w,h) in rects )
+  return (x0, y0, x1-x0, y1-y0)
+
+# crops a row-major pixel buffer of the rectangle r0 to r1.
+def crop_pixels(data, r0, r1):
+  (x0,y0,w0,h0) = r0
+  (x1,y1,w1,h1) = r1
+  bpp = len(data) // (w0*h0)
+  if w0 == w1:
+    return bytes(data[(y1-y0)*w0*bpp:(y1-y0+h1)*w0*bpp])
+  i = ((y1-y0)*w0 + (x1-x0))*bpp
+  return b''.join( bytes(data[i+j*w0*bpp:i+(j*w0+w1)*bpp]) for j in range(h1) )
+
+
+##  RFBDamage
+##
+##  Collects the updates of one output frame in the order they arrive.
+##  Updates outside the clipping are dropped and the rest is cropped to
+##  it, updates that are entirely overdrawn by later ones are removed
+##  and neighbouring updates are merged. Pixels are converted only when
+##  the frame is flushed, so discarded pixels are never converted.
+##
+class RFBDamage:
+
+  # the visible area of an update is given up to this many pieces.
+  MAX_PIECES = 16
+
+  # kinds of update
+  PIXELS = 0                            # native pixel format
+  SOLID = 1                             # native pixel format
+  RGB = 2                               # already converted
+  COPY = 3                              # (sx,sy)
+
+  def __init__(self, clipping):
+    self.clipping = clipping
+    self.updates = []
+    return
+
+  def __len__(self):
+    return len(self.updates)
+
+  def clear(self):
+    self.updates = []
+    return
+
+  def add(self, kind, x, y, width, height, data):
+    rect = intersect_rect((x, y, width, height), self.clipping)
+    if not rect:
+      return
+    cover = rect
+    if kind == self.COPY:
+      (sx, sy) = data
+      data = (sx+rect[0]-x, sy+rect[1]-y)
+      # the updates under the source are needed by this copy.
+      src = (data[0], data[1], rect[2], rect[3])
+      for u in self.updates:
+        if intersect_rect(u[1], src):
+          u[3] = True
+      # the source outside the clipping is not copied.
+      src = intersect_rect(src, self.clipping)
+      if src:
+        cover = (src[0]+rect[0]-data[0], src[1]+rect[1]-data[1], src[2], src[3])
+      else:
+        cover = None
+    elif kind == self.SOLID:
+      data = bytes(data)
+    elif rect != (x, y, width, height):
+      data = crop_pixels(data, (x, y, width, height), rect)
+    elif not isinstance(data, bytes):
+      data = bytes(data)
+    # hide whatever is under the new update.
+    updates = []
+    for u in self.updates:
+      if cover and not u[3] and intersect_rect(u[1], cover):
+        visible = u[4]
+        if len(visible) < self.MAX_PIECES:
+          visible = []
+          for r in u[4]:
+            visible.extend(subtract_rect(r, cover))
+          if not visible:
+            continue
+          u[4] = visible
+      updates.append(u)
+    # [kind, rect, data, pinned, visible]
+    updates.append([kind, rect, data, False, [rect]])
+    self.updates = updates
+    return
+
+  # converts the pending native pixels into RGB (e.g. before the
+  # colour map changes).
+  def convert(self, convert_pixels, convert_color1):
+    for u in self.updates:
+      if u[0] == self.PIXELS:
+        u[0] = self.RGB
+        u[2] = convert_pixels(u[2])
+      elif u[0] == self.SOLID:
+        (_,_,w,h) = u[1]
+        u[0] = self.RGB
+        u[2] = bytes(convert_color1(u[2]))*(w*h)
+    return
+
+  # returns the updates as a list of images.
+  def flush(self, convert_pixels, convert_color1):
+    merged = []
+    for (kind, rect, data, _, visible) in self.updates:
+      bbox = bounding_rect(visible)
+      if bbox != rect:
+        if kind == self.COPY:
+          data = (data[0]+bbox[0]-rect[0], data[1]+bbox[1]-rect[1])
+        elif kind != self.SOLID:
+          data = crop_pixels(data, rect, bbox)
+        rect = bbox
+      if merged:
+        (kind0, rect0, data0) = merged[-1]
+        (x0,y0,w0,h0) = rect0
+        (x,y,w,h) = rect
+        if kind0 != kind or kind == self.COPY:
+          pass
+        elif x0 == x and w0 == w and y0+h0 == y:
+          # stacked vertically.
+          if kind != self.SOLID:
+            merged[-1] = (kind, (x0,y0,w,h0+h), data0+data)
+            continue
+          elif data0 == data:
+            merged[-1] = (kind, (x0,y0,w,h0+h), data)
+            continue
+        elif y0 == y and h0 == h and x0+w0 == x:
+          # side by side.
+          if kind != self.SOLID:
+            n0 = len(data0)//h
+            n = len(data)//h
+            data = b''.join( data0[i*n0:(i+1)*n0]+data[i*n:(i+1)*n] for i in range(h) )
+            merged[-1] = (kind, (x0,y0,w0+w,h), data)
+            continue
+          elif data0 == data:
+            merged[-1] = (kind, (x0,y0,w0+w,h), data)
+            continue
+      merged.append((kind, rect, data))
+    images = []
+    for (kind, (x,y,w,h), data) in merged:
+      if kind == self.PIXELS:
+        img = (IMG_RAW, convert_pixels(data))
+      elif kind == self.SOLID:
+        img = (IMG_SOLID, convert_color1(data))
+      elif kind == self.RGB:
+        img = (IMG_RAW, data)
+      else:
+        img = (IMG_COPYRECT, data)
+      images.append( ((x, y), (w, h, img)) )
+    self.updates = []
+    return images
+
+
 ##  RFBConverter
 ##
 class RFBConverter(RFBFrameBuffer):
@@ -713,23 +2052,56 @@ class RFBConverter(RFBFrameBuffer):
   def __init__(self, info, debug=0):
     self.debug = debug
     self.info = info
+    self.screen_size = None
     return
 
   def init_screen(self, width, height, name):
+    if self.screen_size:
+      return self.resume_screen(width, height, name)
     print('VNC Screen: size=%dx%d, name=%r' % (width, height, name), file=stderr)
+    self.screen_size = (width, height)
     self.info.set_defaults(width, height)
-    self.images = []
+    self.damage = RFBDamage(self.info.clipping)
     self.cursor_image = None
     self.cursor_pos = None
     self.t0 = 0
     return self.info.clipping
 
+  # called when the client has reconnected: the screen, the timing
+  # and the pending updates are kept, so the movie just goes on.
+  def resume_screen(self, width, height, name):
+    print('VNC Screen: resumed, size=%dx%d, name=%r' % (width, height, name), file=stderr)
+    if self.screen_size != (width, height):
+      print('VNC Screen: the size has changed from %dx%d' % self.screen_size, file=stderr)
+    # the movie keeps its size, but only the existing part can be requested.
+    return intersect_rect(self.info.clipping, (0, 0, width, height)) or self.info.clipping
+
   def process_pixels(self, x, y, width, height, data):
-    self.images.append( ((x, y), (width, height, (IMG_RAW, self.convert_pixels(data)))) )
+    self.damage.add(RFBDamage.PIXELS, x, y, width, height, data)
     return
   
   def process_solid(self, x, y, width, height, data):
-    self.images.append( ((x, y), (width, height, (IMG_SOLID, self.convert_color1(data)))) ) 
+    self.damage.add(RFBDamage.SOLID, x, y, width, height, data)
+    return
+
+  def process_rgb(self, x, y, width, height, data):
+    self.damage.add(RFBDamage.RGB, x, y, width, height, data)
+    return
+
+  def copy_rect(self, sx, sy, x, y, width, height):
+    self.damage.add(RFBDamage.COPY, x, y, width, height, (sx, sy))
+    # the pixels outside the clipping are not kept.
+    clipping = self.info.clipping
+    return (intersect_rect((x, y, width, height), clipping) is not None and
+            intersect_rect((sx, sy, width, height), clipping) != (sx, sy, width, height))
+
+  # returns the updates since the last call as images.
+  def get_images(self):
+    return self.damage.flush(self.convert_pixels, self.convert_color1)
+
+  def change_colourmap(self):
+    if self.damage:
+      self.damage.convert(self.convert_pixels, self.convert_color1)
     return
 
   def move_cursor(self, x, y):
@@ -746,11 +2118,19 @@ class RFBConverter(RFBFrameBuffer):
       self.t0 = t
     return int((t - self.t0) * self.info.framerate)+1
 
+  def next_frame_time(self, t):
+    if not self.t0:
+      return t
+    return self.t0 + self.calc_frames(t) / self.info.framerate
+
 
 ##  RFBMovieConverter
 ##
 class RFBMovieConverter(RFBConverter):
 
+  # the decoder states are saved every this many frames (see parse_frame).
+  CHECKPOINT_INTERVAL = 50
+
   def __init__(self, movie, debug=0):
     RFBConverter.__init__(self, movie.info, debug)
     self.movie = movie
@@ -767,42 +2147,101 @@ class RFBMovieConverter(RFBConverter):
       RFBConverter.process_solid(self, x, y, width, height, data)
     return
 
+  def process_rgb(self, x, y, width, height, data):
+    if self.processing:
+      RFBConverter.process_rgb(self, x, y, width, height, data)
+    return
+
+  def copy_rect(self, sx, sy, x, y, width, height):
+    if self.processing:
+      return RFBConverter.copy_rect(self, sx, sy, x, y, width, height)
+    return False
+
   def update_screen(self, t):
-    if not self.processing:
-      frames = RFBConverter.calc_frames(self, t)
-      done = False
-      while len(self.frameinfo) < frames:
-        if done:
-          self.frameinfo.append((self.beginpos, -1))
-        else:
-          endpos = self.rfbparser.tell()
-          self.frameinfo.append((self.beginpos, endpos))
-          if self.debug:
-            print('scan:', self.beginpos, endpos, file=stderr)
-          self.beginpos = endpos
-          done = True
+    if self.scanning:
+      endpos = self.rfbparser.tell()
+      # loop() calls this once more at the end of the file.
+      if self.index and self.index[-1][1] == endpos: return
+      self.index.append((t, endpos))
+      self.add_frames(t, endpos)
     return
 
-  def open(self, fname):
+  # the updates up to endpos (at time t) go to the frames until t.
+  def add_frames(self, t, endpos):
+    frames = RFBConverter.calc_frames(self, t)
+    if len(self.frameinfo) < frames:
+      # frames without any update are empty, so that
+      # no update is parsed twice (zlib streams cannot be replayed).
+      while len(self.frameinfo) < frames-1:
+        self.frameinfo.append((self.beginpos, self.beginpos))
+      self.frameinfo.append((self.beginpos, endpos))
+      if self.debug:
+        print('scan:', self.beginpos, endpos, file=stderr)
+      self.beginpos = endpos
+    return
+
+  # use_index: the frames are found with the index file if it exists.
+  # Otherwise the whole file is scanned and the index is written.
+  def open(self, fname, use_index=True):
     self.processing = False
+    self.scanning = True
     fp = open(fname, 'rb')
     self.rfbparser = RFBFileParser(fp, self, self.debug)
     self.rfbparser.init().auth().start()
     self.beginpos = self.rfbparser.tell()
-    self.rfbparser.loop()
+    self.index = use_index and read_index(fname, self.rfbparser.get_size())
+    if self.index:
+      for (t, endpos) in self.index:
+        self.add_frames(t, endpos)
+    else:
+      self.index = []
+      self.rfbparser.loop()
+      if use_index:
+        write_index(fname, self.index)
+    self.scanning = False
+    # the scan may end with a request without its update.
+    self.rfbparser.reset_requests()
+    # {frame: decoder states before the frame}
+    self.rfbparser.reset_decoders()
+    self.checkpoints = { 0: self.rfbparser.save_decoders() }
+    self.nextframe = 0
     return
 
+  # The zlib based encodings keep their state across updates, so an
+  # update can only be decoded right after the previous one. When a frame
+  # is not the next one, the decoders are restored from the last
+  # checkpoint before it and the frames in between are decoded silently.
   def parse_frame(self, i):
-    (pos, endpos) = self.frameinfo[i]
-    if self.debug:
-      print('seek:', i, pos, endpos, file=stderr)
-    self.rfbparser.seek(pos)
-    self.images = []
+    if i != self.nextframe:
+      j = max( k for k in self.checkpoints if k <= i )
+      if self.nextframe < j or i < self.nextframe:
+        if self.debug:
+          print('restore:', j, i, file=stderr)
+        self.rfbparser.restore_decoders(self.checkpoints[j])
+      else:
+        # going forward from the current frame is shorter.
+        j = self.nextframe
+      self.processing = False
+      for k in range(j, i):
+        self.parse_updates(k)
+    if i % self.CHECKPOINT_INTERVAL == 0 and i not in self.checkpoints:
+      self.checkpoints[i] = self.rfbparser.save_decoders()
+    self.damage.clear()
     self.processing = True
     self.cursor_image = None
     self.cursor_pos = None
-    self.rfbparser.loop(endpos)
-    return (self.images, [], (self.cursor_image, self.cursor_pos))
+    self.parse_updates(i)
+    self.nextframe = i+1
+    return (self.get_images(), [], (self.cursor_image, self.cursor_pos))
+
+  def parse_updates(self, i):
+    (pos, endpos) = self.frameinfo[i]
+    if self.debug:
+      print('seek:', i, pos, endpos, file=stderr)
+    if pos != endpos:
+      self.rfbparser.seek(pos)
+      self.rfbparser.loop(endpos)
+    return
 
 
 ##  RFBStreamConverter
@@ -820,7 +2259,7 @@ class RFBStreamConverter(RFBConverter):
     if not self.stream_opened:
       self.stream.open()
       self.stream_opened = True
-    self.nframes = 0
+      self.nframes = 0
     return clipping
   
   def update_screen(self, t):
@@ -831,10 +2270,84 @@ class RFBStreamConverter(RFBConverter):
         self.stream.next_frame()
         self.nframes += 1
       # And only after that we should paint the frame with the updates
-      self.stream.paint_frame((self.images, [], (self.cursor_image, self.cursor_pos)))
-      self.images = []
+      self.stream.paint_frame((self.get_images(), [], (self.cursor_image, self.cursor_pos)))
       self.cursor_image = None
       self.cursor_pos = None
       self.stream.next_frame()
       self.nframes += 1
     return
+
+
+##  RFBMultiStreamConverter
+##
+##  Feeds several RFBStreamConverters from one connection, e.g. a low
+##  framerate overview and a cropped high framerate movie. Each has its
+##  own SWFInfo (clipping, framerate and scaling). The union of the
+##  clippings is requested and every update is decoded only once; each
+##  converter converts the part in its own clipping.
+##
+class RFBMultiStreamConverter(RFBFrameBuffer):
+
+  def __init__(self, converters, debug=0):
+    self.converters = converters
+    self.debug = debug
+    return
+
+  def set_converter(self, convert_pixels, convert_color1):
+    RFBFrameBuffer.set_converter(self, convert_pixels, convert_color1)
+    for converter in self.converters:
+      converter.set_converter(convert_pixels, convert_color1)
+    return
+
+  def init_screen(self, width, height, name):
+    clippings = [ converter.init_screen(width, height, name) for converter in self.converters ]
+    return bounding_rect(clippings)
+
+  def process_pixels(self, x, y, width, height, data):
+    for converter in self.converters:
+      converter.process_pixels(x, y, width, height, data)
+    return
+
+  def process_solid(self, x, y, width, height, data):
+    for converter in self.converters:
+      converter.process_solid(x, y, width, height, data)
+    return
+
+  def process_rgb(self, x, y, width, height, data):
+    for converter in self.converters:
+      converter.process_rgb(x, y, width, height, data)
+    return
+
+  def change_colourmap(self):
+    for converter in self.converters:
+      converter.change_colourmap()
+    return
+
+  def copy_rect(self, sx, sy, x, y, width, height):
+    lost = False
+    for converter in self.converters:
+      lost = converter.copy_rect(sx, sy, x, y, width, height) or lost
+    return lost
+
+  def move_cursor(self, x, y):
+    for converter in self.converters:
+      converter.move_cursor(x, y)
+    return
+
+  def change_cursor(self, width, height, dx, dy, data):
+    for converter in self.converters:
+      converter.change_cursor(width, height, dx, dy, data)
+    return
+
+  def update_screen(self, t):
+    for converter in self.converters:
+      converter.update_screen(t)
+    return
+
+  def next_frame_time(self, t):
+    return min( converter.next_frame_time(t) for converter in self.converters )
+
+  def close(self):
+    for converter in self.converters:
+      converter.close()
+    return
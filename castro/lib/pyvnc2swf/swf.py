@@ -25,7 +25,7 @@
 
 import sys, zlib
 from struct import pack, unpack
-from io import StringIO
+from io import BytesIO
 stderr = sys.stderr
 lowerbound = max
 upperbound = min
@@ -73,7 +73,7 @@ class DataParser:
     return unpack('<h', self.read(2))[0]
 
   def readub24(self):
-    return unpack('>L', '\x00'+self.read(3))[0]
+    return unpack('>L', b'\x00'+self.read(3))[0]
 
   def readui32(self):
     return unpack('<L', self.read(4))[0]
@@ -122,9 +122,9 @@ class DataParser:
     s = []
     while 1:
       c = self.read(1)
-      if c == '\x00': break
+      if c == b'\x00': break
       s.append(c)
-    return str(''.join(s), self.encoding)
+    return str(b''.join(s), self.encoding)
 
 
 ##  SWFParser
@@ -175,17 +175,17 @@ class SWFParser(DataParser):
 
   def parse_header(self):
     (F,W,S,V) = self.read(4)
-    assert W+S == 'WS'
-    self.swf_version = ord(V)
+    assert bytes((W,S)) == b'WS'
+    self.swf_version = V
     if 6 <= self.swf_version:
       self.encoding = 'utf-8'
     self.totallen = self.readui32()
     if self.debug:
       print('Header:', (F,W,S,self.swf_version,self.totallen), file=stderr)
-    if F == 'C':
+    if F == ord('C'):
       # compressed
       x = zlib.decompress(self.fp.read())
-      self.fp = StringIO(x)
+      self.fp = BytesIO(x)
     self.rect = self.readrect()
     self.framerate = self.readui16()/256
     self.framecount = self.readui16()
@@ -404,8 +404,8 @@ class FLVParser(DataParser):
 
   def parse_header(self):
     (F,L,V,ver) = self.read(4)
-    assert F+L+V == 'FLV'
-    self.flv_version = ord(ver)
+    assert bytes((F,L,V)) == b'FLV'
+    self.flv_version = ver
     flags = self.readui8()
     offset = self.readub32()
     if self.debug:
@@ -422,7 +422,7 @@ class FLVParser(DataParser):
     i0 = 0
     i1 = len(self.tags)
     while i0 < i1:
-      i = (i0+i1)/2
+      i = (i0+i1)//2
       (tag, length, timestamp, offset) = self.tags[i]
       if timestamp < t:
         i0 = i
@@ -474,7 +474,7 @@ class DataWriter:
 
   def push(self):
     self.fpstack.append(self.fp)
-    self.fp = StringIO()
+    self.fp = BytesIO()
     return
 
   def pop(self):
@@ -493,7 +493,7 @@ class DataWriter:
 
   def writeui8(self, *args):
     for x in args:
-      self.fp.write(chr(x).encode('UTF-8'))
+      self.fp.write(pack('<B', x))
     return
   def writesi8(self, *args):
     for x in args:
@@ -555,7 +555,7 @@ class DataWriter:
         # |-----8-bits-----|
         # |-bpos-|---bits----...
         # |      |----r----|
-        self.fp.write(chr(self.buff | (x >> (bits-r))).encode('UTF-8')) # r < bits
+        self.fp.write(pack('<B', self.buff | (x >> (bits-r)))) # r < bits
         self.buff = 0
         self.bpos = 0
         bits -= r                      # cut the upper r bits
@@ -564,7 +564,7 @@ class DataWriter:
   
   def finishbits(self):
     if self.bpos:
-      self.fp.write(chr(self.buff).encode('UTF-8'))
+      self.fp.write(pack('<B', self.buff))
       self.buff = 0
       self.bpos = 0
     return
@@ -572,9 +572,11 @@ class DataWriter:
   # variable length structure
   
   def writestring(self, s):
-    assert '\x00' not in s
+    if isinstance(s, str):
+      s = s.encode('utf-8')
+    assert b'\x00' not in s
     self.write(s)
-    self.write('\x00')
+    self.write(b'\x00')
     return
 
   def writerect(self, xxx_todo_changeme2):
@@ -782,11 +784,11 @@ class SWFWriter(DataWriter):
     self.buff = 0
     self.objid = 0
     if self.compression:
-      self.fp = StringIO()
-      self.fp.write('CWS%c' % self.swf_version)
+      self.fp = BytesIO()
+      self.fp.write(b'CWS%c' % self.swf_version)
     else:
       self.fp = self.outfp
-      self.fp.write('FWS%c' % self.swf_version)
+      self.fp.write(b'FWS%c' % self.swf_version)
     self.lenpos = self.fp.tell()
     self.writeui32(0) # dummy length
     self.writerect(rect)
@@ -836,7 +838,7 @@ class FLVWriter(DataWriter):
   
   def __init__(self, outfile, flv_version, rect, framerate):
     if outfile == '-':
-      self.outfp = sys.stdout
+      self.outfp = sys.stdout.buffer
     else:
       self.outfp = open(outfile, 'wb')
     self.rect = rect
@@ -30,8 +30,11 @@ from struct import pack, unpack
 import threading
 
 from .movie import SWFInfo
-from .output import StreamFactory
-from .rfb import RFBError, RFBNetworkClient, RFBFileParser, RFBNetworkClientForRecording, RFBStreamConverter
+from .output import StreamFactory, ThreadedOutputStream
+from .rfb import RFBError, RFBNetworkClient, RFBFileParser, RFBNetworkClientForRecording, RFBStreamConverter, ENCODINGS
+from .rfb import PIXEL_FORMATS, RFBStats, RFBEncodingTuner, RFBMultiStreamConverter
+from .rfb import AsyncRFBClient, run_async_clients
+from .vncrec import VncRecIndexWriter, VncRecZWriter
 stderr = sys.stderr
 
 
@@ -104,6 +107,8 @@ class RFBNetworkClientWithTkMixin:
   def tk_init(self, root):
     self.root = root
     self.doloop = True
+    # return to the Tk event loop often enough to keep the GUI responsive.
+    self.idle_timeout = 0.05
     return
 
   def interrupt(self):
@@ -137,17 +142,24 @@ class VNC2SWFWithTk:
     ('FLV',       'flv',   'Macromedia Flash Video Files', '.flv'), # 3
     ('MPEG',      'mpeg',  'MPEG Files', '.mpeg'),               # 2
     ('VNCRec',    'vnc',   'VNCRec Files', '.vnc'),              # 4
+    ('VNCRec(compressed)', 'vncz', 'Compressed VNCRec Files', '.vncz'), # 5
     ]
 
   def __init__(self, tempdir, info,
                outtype='swf5', host='localhost', port=5900,
                preferred_encoding=(0,), subprocess=None, pwdfile=None,
-               debug=0):
+               debug=0, pixel_format=None, throttle=None, queue=None, stats=None,
+               auto_encoding=False):
     self.tempdir = tempdir
     self.moviefile = info.filename
     self.info = info
     self.debug = debug
     self.preferred_encoding = preferred_encoding
+    self.pixel_format = pixel_format
+    self.throttle = throttle
+    self.queue = queue
+    self.stats = stats
+    self.auto_encoding = auto_encoding
     self.subprocess = subprocess
     self.pwdfile = pwdfile
     self.outtype = outtype
@@ -300,18 +312,26 @@ class VNC2SWFWithTk:
       moviefile = os.path.join(self.tempdir, 'pyvnc2swf-%d%s' % (os.getpid(), ext))
     self.info.filename = moviefile
     self.fp = None
-    if self.outtype == 'vnc':
+    if self.outtype in ('vnc','vncz'):
       self.fp = open(self.info.filename, 'wb')
+      if self.outtype == 'vncz':
+        self.fp = VncRecZWriter(self.fp)
       self.client = RFBNetworkClientForRecordingWithTk(
         self.host, self.port, self.fp, pwdfile=self.pwdfile,
-        preferred_encoding=self.preferred_encoding)
+        preferred_encoding=self.preferred_encoding,
+        pixel_format=self.pixel_format)
       self.stream = None
     else:
       self.stream = StreamFactory(self.outtype)(self.info)
+      if self.queue:
+        self.stream = ThreadedOutputStream(self.stream, *self.queue)
       self.client = RFBNetworkClientWithTk(
         self.host, self.port, RFBStreamConverter(self.info, self.stream),
         pwdfile=self.pwdfile,
-        preferred_encoding=self.preferred_encoding)
+        preferred_encoding=self.preferred_encoding,
+        pixel_format=self.pixel_format, throttle=self.throttle,
+        stats=self.stats and RFBStats(self.stats),
+        tuner=self.auto_encoding and RFBEncodingTuner() or None)
     self.set_status()
     return True
     
@@ -392,62 +412,98 @@ class VNC2SWFWithTk:
     return
 
 
+##  reconnect_client - connects the client again.
+##
+##  Tries retries times, waiting 1, 2, 4, ... (at most RECONNECT_MAX_WAIT)
+##  seconds before each attempt. The password is not asked again.
+##
+RECONNECT_MAX_WAIT = 30
+def reconnect_client(client, retries):
+  try:
+    for i in range(retries):
+      time.sleep(min(2**i, RECONNECT_MAX_WAIT))
+      client.disconnect()
+      try:
+        client.init().auth().start()
+        return True
+      except (socket.error, RFBError) as e:
+        print('Reconnect failed:', e, file=stderr)
+  except KeyboardInterrupt:
+    pass
+  return False
+
+
 ##  vnc2swf - CLI routine
 ##
 def vnc2swf(info, outtype='swf5', host='localhost', port=5900, 
             preferred_encoding=(0,), subprocess=None, pwdfile=None, vncfile=None,
-            debug=0, merge=False, reconnect=0):
+            debug=0, merge=False, reconnect=0, pixel_format=None, throttle=None,
+            queue=None, stats=None, auto_encoding=False, outputs=()):
+  # outputs: additional (info, outtype) recorded from the same connection.
   fp = None
-  if outtype == 'vnc':
-    stream = None
+  streams = []
+  if outtype in ('vnc','vncz'):
+    index = None
     if info.filename == '-':
-      fp = sys.stdout
+      fp = sys.stdout.buffer
     else:
       fp = open(info.filename, 'wb')
+      index = VncRecIndexWriter(info.filename)
+    if outtype == 'vncz':
+      fp = VncRecZWriter(fp)
     client = RFBNetworkClientForRecording(host, port, fp, pwdfile=pwdfile,
-                                          preferred_encoding=preferred_encoding, debug=debug)
+                                          preferred_encoding=preferred_encoding, debug=debug,
+                                          pixel_format=pixel_format, index=index)
   else:
-    stream = StreamFactory(outtype)(info, debug=debug)
-    converter = RFBStreamConverter(info, stream, debug=debug)
+    converters = []
+    for (i, t) in [(info, outtype)] + list(outputs):
+      stream = StreamFactory(t)(i, debug=debug)
+      if queue:
+        stream = ThreadedOutputStream(stream, *queue, debug=debug)
+      streams.append((i, stream))
+      converters.append(RFBStreamConverter(i, stream, debug=debug))
+    if len(converters) == 1:
+      converter = converters[0]
+    else:
+      converter = RFBMultiStreamConverter(converters, debug=debug)
     if vncfile:
       client = RFBFileParser(vncfile, converter, debug=debug)
     else:
       client = RFBNetworkClient(host, port, converter, pwdfile=pwdfile,
-                                preferred_encoding=preferred_encoding, debug=debug)
+                                preferred_encoding=preferred_encoding, debug=debug,
+                                pixel_format=pixel_format, throttle=throttle,
+                                tuner=auto_encoding and RFBEncodingTuner() or None)
+  if stats:
+    client.stats = RFBStats(stats)
   try:
     client.init().auth().start()
-  except socket.error as e:
-    print('Socket error:', e, file=stderr)
-  except RFBError as e:
-    print('RFB error:', e, file=stderr)
+    connected = True
+  except (socket.error, RFBError) as e:
+    print('Connection failed:', e, file=stderr)
+    connected = not vncfile and reconnect_client(client, reconnect)
   if debug:
     print('start recording', file=stderr)
   if subprocess:
     subprocess.start()
-  for i in range(reconnect + 1)[::-1]:
+  while connected:
     try:
       client.loop()
-    except KeyboardInterrupt:
       break
-    except socket.error as e:
-      print('Socket error:', e, file=stderr)
-      if i:
-        time.sleep(1)
-        client.init().auth().start()
-    except RFBError as e:
-      print('RFB error:', e, file=stderr)
-      if i:
-        time.sleep(1)
-        client.init().auth().start()
-    else:
+    except KeyboardInterrupt:
       break
+    except (socket.error, RFBError) as e:
+      print('Connection lost:', e, file=stderr)
+      # the movie goes on where it stopped (see RFBConverter.resume_screen).
+      connected = not vncfile and reconnect_client(client, reconnect)
   if debug:
     print('stop recording', file=stderr)
   if subprocess:
     subprocess.stop()
   client.close()
-  if stream:
+  for (i, stream) in streams:
     stream.close()
+    if i is not info:
+      i.write_html()
   info.write_html()
   if fp:
     fp.close()
@@ -479,6 +535,54 @@ def vnc2swf(info, outtype='swf5', host='localhost', port=5900,
   return
 
 
+##  vnc2swf_many - records many displays in one process
+##
+##  recordings: list of (info, outtype, host, port).
+##  All the displays are read by one asyncio event loop and encoded
+##  by a pool of max_workers threads.
+##
+def vnc2swf_many(recordings, preferred_encoding=(0,), pwdfile=None,
+                 max_workers=8, debug=0, pixel_format=None, throttle=None,
+                 queue=None, stats=None, auto_encoding=False):
+  outputs = []
+  clients = []
+  for (info, outtype, host, port) in recordings:
+    stream = StreamFactory(outtype)(info, debug=debug)
+    if queue:
+      stream = ThreadedOutputStream(stream, *queue, debug=debug)
+    converter = RFBStreamConverter(info, stream, debug=debug)
+    clients.append(AsyncRFBClient(host, port, converter, pwdfile=pwdfile,
+                                  preferred_encoding=preferred_encoding, debug=debug,
+                                  pixel_format=pixel_format, throttle=throttle,
+                                  stats=stats and RFBStats(stats, name='%s:%d' % (host, port)),
+                                  tuner=auto_encoding and RFBEncodingTuner() or None))
+    outputs.append((info, stream, converter))
+  if debug:
+    print('start recording: %d displays' % len(clients), file=stderr)
+  run_async_clients(clients, max_workers=max_workers)
+  if debug:
+    print('stop recording', file=stderr)
+  for (info, stream, converter) in outputs:
+    if converter.stream_opened:
+      stream.close()
+      info.write_html()
+  return
+
+
+# Returns the output type for a file name.
+def guess_outtype(filename):
+  if filename.endswith('.vnc'):
+    return 'vnc'
+  elif filename.endswith('.vncz'):
+    return 'vncz'
+  elif filename.endswith('.swf'):
+    return 'swf5'
+  elif filename.endswith('.mpg') or filename.endswith('.mpeg'):
+    return 'mpeg'
+  elif filename.endswith('.flv'):
+    return 'flv'
+  return None
+
 # Thread management
 class RecordingThread:
   def __init__(self, outputfile):
@@ -531,22 +635,62 @@ class Subprocess:
 def main(argv):
   import getopt
   def usage():
-    print(('usage: %s [-d] [-n] [-o filename] [-t {flv|mpeg|swf5|swf7|vnc}]'
-           ' [-e encoding] [-N] [-C clipping] [-r framerate] [-s scaling] [-z] [-m] [-a] [-V]'
-           ' [-S subprocess] [-P pwdfile] [host[:display] [port]]' % argv[0]))
+    print(('usage: %s [-d] [-n] [-o filename] [-O filename[,clipping[,framerate[,scaling]]]] [-t {flv|mpeg|swf5|swf7|vnc|vncz}]'
+           ' [-e encoding|auto] [-f pixelformat] [-T lookahead] [-Q depth[:policy]] [-I interval] [-N] [-C clipping] [-r framerate] [-s scaling] [-j threads] [-v {1|2}] [-z] [-m] [-a] [-V]'
+           ' [-S subprocess] [-P pwdfile] [-R retries] [host[:display] [port]]' % argv[0]))
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'dno:t:e:NC:r:S:P:s:zmaVR:')
+    (opts, args) = getopt.getopt(argv[1:], 'dno:O:t:e:f:T:Q:I:NC:r:S:P:s:zmaVR:j:v:')
   except getopt.GetoptError:
     return usage()
   (debug, console, outtype, subprocess, merge, pwdfile, isfile) = (0, False, None, None, False, None, False)
   (cursor, host, port, preferred_encoding) = (True, 'localhost', 5900, (0,))
+  pixel_format = None
+  throttle = None
+  queue = None
+  stats = None
+  auto_encoding = False
+  reconnect = 0
+  outputs = []
   info = SWFInfo()
   for (k, v) in opts:
     if k == '-d': debug += 1
     elif k == '-n': console = True
     elif k == '-t': outtype = v
-    elif k == '-e': preferred_encoding = tuple([ int(i) for i in v.split(',') ])
+    elif k == '-e':
+      # encodings are given by number or name, e.g. "zrle,hextile,0".
+      # "auto" measures the candidates and picks the fastest one
+      # (hextile is used where this is not possible, i.e. for vncrec).
+      names = [ e.lower() for e in v.split(',') ]
+      auto_encoding = 'auto' in names
+      try:
+        preferred_encoding = tuple([ ENCODINGS[e] if e in ENCODINGS else int(e)
+                                     for e in names if e != 'auto' ])
+        if auto_encoding:
+          preferred_encoding = (5,0) + preferred_encoding
+      except ValueError:
+        print('Invalid encoding: %s (choose from %s or a number)' % (v, ','.join(sorted(ENCODINGS))))
+        return usage()
+    elif k == '-f':
+      if v.lower() not in PIXEL_FORMATS:
+        print('Invalid pixel format: %s (choose from %s)' % (v, ','.join(sorted(PIXEL_FORMATS))))
+        return usage()
+      pixel_format = v.lower()
+    elif k == '-T':
+      # request updates only for the output frames,
+      # the given seconds before each frame.
+      throttle = float(v)
+    elif k == '-Q':
+      # encode in a separate thread, e.g. "16:merge".
+      (depth, _, policy) = v.partition(':')
+      policy = policy or 'block'
+      if not depth.isdigit() or policy not in ThreadedOutputStream.POLICIES:
+        print('Invalid queue: %s (depth[:%s])' % (v, '|'.join(ThreadedOutputStream.POLICIES)))
+        return usage()
+      queue = (int(depth), policy)
+    elif k == '-I':
+      # dump the transport statistics every given seconds.
+      stats = float(v)
     elif k == '-N': cursor = False
     elif k == '-S': subprocess = Subprocess(v)
     elif k == '-a': subprocess = RecordingThread(v)
@@ -555,8 +699,34 @@ def main(argv):
     elif k == '-V': isfile = True
     elif k == '-o':
       info.filename = v
+    elif k == '-O':
+      # another output from the same connection: file[,clipping[,framerate[,scaling]]]
+      # e.g. "window.flv,640x480+100+50,24" or "overview.swf,,2,0.5"
+      f = v.split(',') + ['']*3
+      i = SWFInfo(f[0])
+      try:
+        if f[1]:
+          i.set_clipping(f[1])
+        i.framerate = float(f[2] or 12)
+        if f[3]:
+          i.scaling = float(f[3])
+      except ValueError:
+        print('Invalid output: %s' % v)
+        return usage()
+      t = guess_outtype(i.filename)
+      if t not in ('swf5','mpeg','flv'):
+        print('Please specify the file extension of the output: %s' % v)
+        return usage()
+      outputs.append((i, t))
     elif k == '-R':
-      reconnect = v
+      reconnect = int(v)
+    elif k == '-j':
+      # threads for compressing video blocks (1: serial).
+      info.threads = int(v)
+    elif k == '-v':
+      # ScreenVideo version (1: for old players).
+      info.screenvideo = int(v)
+      assert info.screenvideo in (1, 2), 'Invalid ScreenVideo version.'
     elif k == '-C':
       try:
         info.set_clipping(v)
@@ -572,19 +742,20 @@ def main(argv):
       assert 0 < info.scaling and info.scaling <= 1.0, 'Invalid scaling.'
   if not outtype:
     if info.filename:
-      if info.filename.endswith('.vnc'):
-        outtype = 'vnc'
-      elif info.filename.endswith('.swf'):
-        outtype = 'swf5'
-      elif info.filename.endswith('.mpg') or info.filename.endswith('.mpeg'):
-        outtype = 'mpeg'
-      elif info.filename.endswith('.flv'):
-        outtype = 'flv'
+      outtype = guess_outtype(info.filename)
     else:
       outtype = 'swf5'
-  if outtype not in ('swf5','swf7','vnc','mpeg','flv'):
+  if outtype not in ('swf5','swf7','vnc','vncz','mpeg','flv'):
     print('Please specify the output type or file extension.')
     return usage()
+  if outputs and outtype in ('vnc','vncz'):
+    print('-O cannot be used with vncrec output.')
+    return usage()
+  for (i, t) in outputs:
+    i.threads = info.threads
+    i.screenvideo = info.screenvideo
+  if debug and stats is None:
+    stats = 1.0
   if cursor:
     preferred_encoding += (-232,-239,)
   if 1 <= len(args):
@@ -602,13 +773,15 @@ def main(argv):
       return usage()
     vncfile = None
     if isfile:
-      vncfile = sys.stdin
+      vncfile = sys.stdin.buffer
       if args:
         vncfile = open(args[0], 'rb')
     vnc2swf(info, outtype, host, port,
             preferred_encoding=preferred_encoding,
             subprocess=subprocess, pwdfile=pwdfile, vncfile=vncfile,
-            merge=merge, debug=debug, reconnect=reconnect)
+            merge=merge, debug=debug, reconnect=reconnect,
+            pixel_format=pixel_format, throttle=throttle, queue=queue,
+            stats=stats, auto_encoding=auto_encoding, outputs=outputs)
   else:
     tempdir = os.path.join(tempfile.gettempdir(), 'pyvnc2swf')
     try:
@@ -618,7 +791,9 @@ def main(argv):
     VNC2SWFWithTk(tempdir, info, outtype, host, port,
                   preferred_encoding=preferred_encoding,
                   subprocess=subprocess, pwdfile=pwdfile,
-                  debug=debug).run()
+                  debug=debug, pixel_format=pixel_format,
+                  throttle=throttle, queue=queue, stats=stats,
+                  auto_encoding=auto_encoding).run()
   return
 
 if __name__ == "__main__": sys.exit(main(sys.argv))
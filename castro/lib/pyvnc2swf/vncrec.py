@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+##
+##  pyvnc2swf - vncrec.py
+##
+##  This is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This software is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this software; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307,
+##  USA.
+##
+
+import sys, os, zlib
+from bisect import bisect_right
+from struct import pack, unpack, calcsize, iter_unpack
+stderr = sys.stderr
+
+
+##  Frame index of vncrec files
+##
+##  A vncrec file (vncLog0.0) can only be read from the beginning, so
+##  finding the frames of a long recording takes a long time. The index
+##  is kept next to it (<file>.idx) and has one record per update:
+##  the time of the update and the offset where it ends in the file.
+##
+##    'vncIdx0.0' (time: double, offset: uint64)*
+##
+INDEX_MAGIC = b'vncIdx0.0'
+INDEX_RECORD = '>dQ'
+
+def index_filename(fname):
+  return fname+'.idx'
+
+
+##  VncRecIndexWriter
+##
+class VncRecIndexWriter:
+
+  def __init__(self, fname):
+    self.fp = open(index_filename(fname), 'wb')
+    self.fp.write(INDEX_MAGIC)
+    return
+
+  def add(self, t, offset):
+    self.fp.write(pack(INDEX_RECORD, t, offset))
+    return
+
+  def close(self):
+    self.fp.close()
+    return
+
+
+# returns [(time, offset), ...] of a vncrec file, or None if there is
+# no index or it does not cover the whole file (e.g. after a crash).
+# size: the (uncompressed) size of the recording.
+def read_index(fname, size=None):
+  try:
+    with open(index_filename(fname), 'rb') as fp:
+      data = fp.read()
+    if size is None:
+      size = os.path.getsize(fname)
+  except (IOError, OSError):
+    return None
+  if not data.startswith(INDEX_MAGIC):
+    return None
+  data = data[len(INDEX_MAGIC):]
+  # an unfinished record is ignored.
+  data = data[:len(data)-len(data) % 16]
+  index = list(iter_unpack(INDEX_RECORD, data))
+  # a stopped recording may end with the timestamp of an unanswered request.
+  if not index or index[-1][1] < size-8 or size < index[-1][1]:
+    return None
+  return index
+
+# writes an index made by scanning the file. returns False on failure.
+def write_index(fname, index):
+  try:
+    writer = VncRecIndexWriter(fname)
+    for (t, offset) in index:
+      writer.add(t, offset)
+    writer.close()
+  except (IOError, OSError) as e:
+    print('Cannot write the index: %s' % e, file=stderr)
+    return False
+  return True
+
+
+##  Compressed vncrec files
+##
+##  A vncLogZ.0 file holds a vncLog0.0 stream in zlib chunks.
+##  Each chunk is compressed on its own and ends at an update boundary,
+##  so the stream can be read from any chunk. The chunk table at the end
+##  maps the stream offsets to the file offsets:
+##
+##    'vncLogZ.0' chunk* (0: uint32, 0: uint32) table trailer
+##    chunk: (zsize: uint32, size: uint32) zlib-data
+##    table: (offset: uint64, fileoffset: uint64)*
+##    trailer: (nchunks: uint32, tableoffset: uint64) 'vncZTbl'
+##
+ZLOG_MAGIC = b'vncLogZ.0'
+ZLOG_CHUNK = '>LL'
+ZLOG_TABLE = '>QQ'
+ZLOG_TRAILER = '>LQ'
+ZLOG_TRAILER_MAGIC = b'vncZTbl'
+
+
+##  VncRecZWriter
+##
+##  A file object for RFBNetworkClientForRecording.
+##  Data is buffered and compressed when a chunk is full.
+##
+class VncRecZWriter:
+
+  # level 1 keeps up with raw updates and still
+  # shrinks them by an order of magnitude.
+  def __init__(self, fp, chunksize=1024*1024, level=1):
+    self.fp = fp
+    self.chunksize = chunksize
+    self.level = level
+    self.buf = bytearray()
+    self.offset = 0
+    self.fileoffset = len(ZLOG_MAGIC)
+    self.table = []
+    self.fp.write(ZLOG_MAGIC)
+    return
+
+  def __repr__(self):
+    return '<VncRecZWriter: %r>' % self.fp
+
+  def write(self, data):
+    self.buf += data
+    return
+
+  # called at the end of each update.
+  def end_update(self):
+    if self.chunksize <= len(self.buf):
+      self.flush_chunk()
+    return
+
+  def flush_chunk(self):
+    if not self.buf: return
+    data = zlib.compress(self.buf, self.level)
+    self.fp.write(pack(ZLOG_CHUNK, len(data), len(self.buf)) + data)
+    self.table.append((self.offset, self.fileoffset))
+    self.offset += len(self.buf)
+    self.fileoffset += calcsize(ZLOG_CHUNK)+len(data)
+    self.buf = bytearray()
+    return
+
+  def flush(self):
+    self.flush_chunk()
+    self.fp.flush()
+    return
+
+  def close(self):
+    self.flush_chunk()
+    self.fp.write(pack(ZLOG_CHUNK, 0, 0) +
+                  b''.join( pack(ZLOG_TABLE, *x) for x in self.table ) +
+                  pack(ZLOG_TRAILER, len(self.table), self.fileoffset+calcsize(ZLOG_CHUNK)) +
+                  ZLOG_TRAILER_MAGIC)
+    self.fp.close()
+    return
+
+
+##  VncRecZReader
+##
+##  A file object that reads the vncLog0.0 stream of a vncLogZ.0 file
+##  (after the magic). Reading is sequential, so pipes can be read too.
+##  The chunk table is only needed for seeking.
+##
+class VncRecZReader:
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.table = None
+    self.data = b''
+    self.chunkoffset = 0
+    self.pos = 0
+    self.nextfileoffset = len(ZLOG_MAGIC)
+    return
+
+  def __repr__(self):
+    return '<VncRecZReader: %r>' % self.fp
+
+  # reads the chunk at the current position of the file.
+  # returns False at the end of the chunks.
+  def read_chunk(self):
+    if self.table is not None:
+      self.fp.seek(self.nextfileoffset)
+    header = self.fp.read(calcsize(ZLOG_CHUNK))
+    if len(header) < calcsize(ZLOG_CHUNK):
+      return False
+    (zsize, size) = unpack(ZLOG_CHUNK, header)
+    if not zsize:
+      return False
+    try:
+      data = zlib.decompress(self.fp.read(zsize))
+    except zlib.error:
+      # an unfinished chunk.
+      return False
+    if len(data) != size:
+      return False
+    self.chunkoffset += len(self.data)
+    self.data = data
+    self.nextfileoffset += calcsize(ZLOG_CHUNK)+zsize
+    return True
+
+  def read(self, n):
+    i = self.pos-self.chunkoffset
+    x = self.data[i:i+n]
+    while len(x) < n and self.read_chunk():
+      x += self.data[:n-len(x)]
+    self.pos += len(x)
+    return x
+
+  def tell(self):
+    return self.pos
+
+  # returns [(offset, fileoffset), ...] of the chunks.
+  def get_table(self):
+    if self.table is None:
+      self.table = self.read_table()
+      if self.table is None:
+        self.table = self.scan_table()
+    return self.table
+
+  def read_table(self):
+    n = calcsize(ZLOG_TRAILER)+len(ZLOG_TRAILER_MAGIC)
+    try:
+      self.fp.seek(-n, 2)
+    except (IOError, OSError):
+      return None
+    trailer = self.fp.read(n)
+    if not trailer.endswith(ZLOG_TRAILER_MAGIC):
+      return None
+    (nchunks, tableoffset) = unpack(ZLOG_TRAILER, trailer[:calcsize(ZLOG_TRAILER)])
+    self.fp.seek(tableoffset)
+    return list(iter_unpack(ZLOG_TABLE, self.fp.read(nchunks*calcsize(ZLOG_TABLE))))
+
+  # a file without the table (e.g. after a crash) is scanned.
+  def scan_table(self):
+    table = []
+    (offset, fileoffset) = (0, len(ZLOG_MAGIC))
+    filesize = os.fstat(self.fp.fileno()).st_size
+    while 1:
+      self.fp.seek(fileoffset)
+      header = self.fp.read(calcsize(ZLOG_CHUNK))
+      if len(header) < calcsize(ZLOG_CHUNK):
+        break
+      (zsize, size) = unpack(ZLOG_CHUNK, header)
+      if not zsize or filesize < fileoffset+calcsize(ZLOG_CHUNK)+zsize:
+        break
+      table.append((offset, fileoffset))
+      offset += size
+      fileoffset += calcsize(ZLOG_CHUNK)+zsize
+    return table
+
+  # the size of the stream.
+  def get_size(self):
+    table = self.get_table()
+    if not table:
+      return 0
+    (offset, fileoffset) = table[-1]
+    self.fp.seek(fileoffset)
+    (_, size) = unpack(ZLOG_CHUNK, self.fp.read(calcsize(ZLOG_CHUNK)))
+    return offset+size
+
+  def seek(self, pos):
+    if not (self.chunkoffset <= pos and pos <= self.chunkoffset+len(self.data)):
+      table = self.get_table()
+      i = bisect_right(table, (pos, 0xffffffffffffffff))-1
+      if 0 <= i:
+        (self.chunkoffset, self.nextfileoffset) = table[i]
+        self.data = b''
+        self.read_chunk()
+    self.pos = pos
+    return
+
+  def close(self):
+    self.fp.close()
+    return